@@ -58,6 +58,9 @@ class GDCcli(argparse.ArgumentParser):
                          help='Process data ONLY from these GDC projects')
         self.add_argument('--cases', nargs='+', metavar='case_id',
                          help='Process data ONLY from these GDC cases')
+        self.add_argument('--no-cache', action='store_true',
+                         help='Always query the GDC, bypassing the on-disk '
+                         'cache of metadata query responses')
         self.add_argument('datestamp', nargs='?', help='Use GDC data for a'
                           ' specific date. If omitted, the latest available'
                           ' data will be used.')
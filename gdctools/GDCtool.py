@@ -26,6 +26,7 @@ from GDCcli import GDCcli
 from GDCcore import *
 from lib import common
 from lib import api
+from lib.cache import ResponseCache
 
 class GDCtool(object):
     ''' Base class for each tool in the GDCtools suite '''
@@ -38,7 +39,6 @@ class GDCtool(object):
     def execute(self):
         self.options = self.cli.parse_args()
         self.parse_config()
-        self.reconcile_config()
 
         # Get today's datestamp, the default value
         datestamp = time.strftime('%Y_%m_%d', time.localtime())
@@ -62,6 +62,11 @@ class GDCtool(object):
                                  + "Existing datestamps: " + repr(existing_stamps))
 
         self.datestamp = datestamp
+
+        # The datestamp must be known before reconciling the config, because
+        # that may query the GDC and so consult the (datestamped) cache
+        self.init_cache()
+        self.reconcile_config()
         self.init_logging()
 
     def get_config_values_as_list(self, values):
@@ -157,6 +162,43 @@ class GDCtool(object):
         if opts.verbose:
             api.set_verbosity(opts.verbose)
 
+    def init_cache(self):
+        '''
+        Configure the on-disk cache of GDC metadata query responses, from the
+        optional [cache] config section:
+            DIR             cache folder, default <root_dir>/cache
+            MAX_MB          size beyond which least recently used entries
+                            are evicted
+            TTL_<ENDPOINT>  seconds before responses from <endpoint> expire
+                            (e.g. TTL_PROJECTS); 0 disables caching them
+            PIN             when a datestamp is given explicitly, reuse the
+                            responses cached on that date (default: yes)
+        '''
+        config = self.config
+        cache_config = config.cache or attrdict()
+        if self.options.no_cache:
+            api.set_cache(None)
+            return
+
+        cache_dir = cache_config.dir
+        if not cache_dir:
+            cache_dir = os.path.join(config.root_dir, "cache")
+
+        max_bytes = None
+        if cache_config.max_mb:
+            max_bytes = int(float(cache_config.max_mb) * 1024 * 1024)
+
+        ttls = dict()
+        for option, value in cache_config.items():
+            if option.startswith("ttl_"):
+                ttls[option[len("ttl_"):]] = int(value)
+
+        pin = (cache_config.pin or "yes").lower() in ["1", "true", "on", "yes"]
+        pinned = pin and bool(self.options.datestamp)
+
+        api.set_cache(ResponseCache(cache_dir, max_bytes=max_bytes, ttls=ttls,
+                                    datestamp=self.datestamp, pinned=pinned))
+
     def validate_config(self, vars_to_examine, UnsetValue=None):
         '''
         Ensure that sufficient configuration state has been defined for tool to
@@ -21,6 +21,7 @@ import os
 import sys
 import gzip
 from collections import defaultdict, Counter
+from contextlib import closing
 from pkg_resources import resource_filename
 
 from lib.convert import seg as gdac_seg
@@ -31,6 +32,7 @@ from lib.convert import copy as gdac_copy
 from lib.convert import maf as mutect_maf
 from lib import common
 from lib import meta
+from lib.manifest import Manifest
 from lib.common import REPORT_DATA_TYPES, ANNOT_TO_DATATYPE
 
 from GDCtool import GDCtool
@@ -96,7 +98,8 @@ class gdc_dice(GDCtool):
 
         # Ensure no simultaneous mirroring/dicing
         with common.lock_context(diced_prog_root, "dice"), \
-             common.lock_context(mirror_prog_root, "mirror"):
+             common.lock_context(mirror_prog_root, "mirror"), \
+             closing(Manifest(mirror_prog_root)) as mirrored:
 
             logging.info("Dicing " + program)
 
@@ -110,24 +113,18 @@ class gdc_dice(GDCtool):
                 # Load metadata from mirror, getting the latest metadata
                 # earlier than the given datestamp
                 raw_project_root = os.path.join(mirror_prog_root, project)
-                meta_dir = os.path.join(raw_project_root, "metadata", datestamp)
-                #TODO: This is a very redundant format, and doesn't fix the ls issue
-                # Should reorganize the metadata folder structure to
-                # .../proj/metadata/YYYY/metadata.project.<date>.json
-                meta_file = os.path.join(meta_dir,
-                                         '.'.join(["metadata", project,
-                                                   datestamp, "json"]))
 
                 # Sanity check, there must be saved metadata for each
                 # project in order to dice
-                if not os.path.exists(meta_file):
+                if not meta.has_metadata(raw_project_root, datestamp):
                     _warning =  "No metadata found for " + project
                     _warning += " on " + datestamp
                     raise ValueError(_warning)
 
-                # Read json metadata as a dict
-                with open(meta_file) as mf:
-                    metadata = json.load(mf)
+                # Read json metadata as a dict (stored in full, perhaps with
+                # a compact companion, or as a delta from an earlier mirror)
+                metadata = meta.read_project_metadata(raw_project_root,
+                                                      datestamp)
 
                 # metadata = meta.latest_metadata(latest_meta)
 
@@ -166,20 +163,25 @@ class gdc_dice(GDCtool):
                                          delimiter='\t')
                     mfw.writeheader()
 
+                    # Files missing from the manifest are looked up in a
+                    # single scan of each folder of the mirror
+                    snapshot = meta.MirrorSnapshot(raw_project_root)
                     for tcga_id in tcga_lookup:
                         # Dice single sample files first
                         for _, file_d in tcga_lookup[tcga_id].iteritems():
                             dice_one(file_d, trans_dict, raw_project_root,
                                      diced_project_root, mfw,
                                      dry_run=self.options.dry_run,
-                                     force=self.force_dice)
+                                     force=self.force_dice,
+                                     manifest=mirrored, snapshot=snapshot)
 
                     #Then dice the multi_sample_files
                     for file_d in multi_sample_files:
                         dice_one(file_d, trans_dict, raw_project_root,
                                  diced_project_root, mfw,
                                  dry_run=self.options.dry_run,
-                                 force=self.force_dice)
+                                 force=self.force_dice,
+                                 manifest=mirrored, snapshot=snapshot)
 
                 # Bookkeeping code -- write some useful tables
                 # and figures needed for downstream sample reports.
@@ -353,15 +355,20 @@ def build_translation_dict(translation_file):
     return d
 
 def dice_one(file_dict, translation_dict, mirror_proj_root, diced_root,
-             meta_file_writer, dry_run=False, force=False):
+             meta_file_writer, dry_run=False, force=False, manifest=None,
+             snapshot=None):
     """Dice a single file from a GDC mirror.
 
     Diced data will be placed in /<diced_root>/<annotation>/. If dry_run is
     true, a debug message will be displayed instead of performing the actual
-    dicing operation.
+    dicing operation.  If the mirror manifest is given, files recorded there
+    are not looked for on disk, and other files found on disk are recorded.
+    If a MirrorSnapshot of the mirrored project is given, files are looked
+    up in it instead of on disk.
     """
     mirror_path = meta.mirror_path(mirror_proj_root, file_dict)
-    if not os.path.isfile(mirror_path):
+    if not is_mirrored(file_dict, mirror_proj_root, mirror_path, manifest,
+                       snapshot):
         # Bad, this means there are integrity issues
         raise ValueError("Expected mirror file missing: " + mirror_path)
     else:
@@ -396,6 +403,23 @@ def dice_one(file_dict, translation_dict, mirror_proj_root, diced_root,
             logging.warn('Unrecognized data:\n%s' % json.dumps(warning_info,
                                                                indent=2))
 
+def is_mirrored(file_dict, mirror_proj_root, mirror_path, manifest=None,
+                snapshot=None):
+    """Returns true if the file is recorded in the mirror manifest (if given)
+    or, failing that, is present on disk (as seen by snapshot, if given).
+    Files found on disk with a matching .md5 file are recorded in the
+    manifest."""
+    if manifest is not None:
+        if manifest.is_mirrored(file_dict):
+            return True
+        project = os.path.basename(mirror_proj_root)
+        if manifest.record_from_disk(project, file_dict, mirror_path, None,
+                                     snapshot=snapshot):
+            return True
+    if snapshot is not None:
+        return snapshot.exists(file_dict)
+    return os.path.isfile(mirror_path)
+
 def get_annotation_converter(file_dict, translation_dict):
     k = metadata_to_key(file_dict)
     if k in translation_dict:
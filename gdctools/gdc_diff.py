@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+Copyright (c) 2016 The Broad Institute, Inc.  All rights are reserved.
+
+gdc_diff: report what changed in a mirror (or dice) between two datestamps
+
+@author: agent
+@date:  2026_10_18
+'''
+
+# }}}
+
+from __future__ import print_function
+import sys
+import os
+import csv
+from itertools import groupby
+from collections import Counter
+
+from GDCcore import *
+from GDCtool import GDCtool
+import lib.meta as meta
+import lib.common as common
+from lib.common import DATESTAMP_REGEX
+
+class gdc_diff(GDCtool):
+
+    def __init__(self):
+        super(gdc_diff, self).__init__(version="0.1.0", logging=False)
+        cli = self.cli
+
+        cli.description = 'Report the files added, removed or changed in a '\
+            'GDC mirror between two\ndatestamps (by default the latest two), '\
+            'or with --dice the samples whose\ndiced data were added, removed '\
+            'or changed, in each annotation.\n\nEach datestamp is compared by '\
+            'a single pass over uuid-sorted indexes of\nits metadata, so only '\
+            'a few rows are held in memory at once.'
+
+        cli.add_argument('later', nargs='?',
+                         help='Compare with the data of this (later) datestamp,'
+                         ' instead of the latest')
+        cli.add_argument('--dice', action='store_true',
+                         help='Compare diced data (samples per annotation) '
+                         'instead of mirrored files')
+        cli.add_argument('-s', '--summary', action='store_true',
+                         help='Report only the number of items added, removed '
+                         'and changed per project and category (or annotation)')
+        cli.add_argument('-o', '--output',
+                         help='Write the report to this file instead of stdout')
+
+    def execute(self):
+        super(gdc_diff, self).execute()
+        config = self.config
+        opts = self.options
+
+        # Resolve the pair of datestamps to compare
+        stamps = self.datestamps()
+        if opts.datestamp:
+            earlier = self.datestamp
+        elif len(stamps) >= 2:
+            earlier = stamps[-2]
+        else:
+            gabort(1, "At least 2 datestamps are needed to compare, found: " +
+                   repr(stamps))
+        later = opts.later or "latest"
+        if later == "latest":
+            later = stamps[-1]
+        elif later not in stamps:
+            gabort(1, "Given datestamp not present in " + config.datestamps +
+                   "\nExisting datestamps: " + repr(stamps))
+        if later < earlier:
+            earlier, later = later, earlier
+
+        if opts.dice:
+            root = config.dice.dir
+            header = ['status', 'project', 'annotation', 'sample', 'file_name']
+            diff = diff_dice
+        else:
+            root = config.mirror.dir
+            header = ['status', 'project', 'data_category', 'uuid',
+                      'file_name']
+            diff = diff_mirror
+        if not root or not os.path.isdir(root):
+            gabort(1, "No %s data found in %s" % \
+                   ("diced" if opts.dice else "mirrored", root))
+
+        out = open(opts.output, 'w') if opts.output else sys.stdout
+        try:
+            writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+            if opts.summary:
+                writer.writerow(['project', header[2]] + STATUSES)
+            else:
+                writer.writerow(header)
+
+            programs = config.programs or common.immediate_subdirs(root)
+            for prgm in programs:
+                prgm_root = os.path.join(root, prgm)
+                if not os.path.isdir(prgm_root):
+                    continue
+                projects = common.immediate_subdirs(prgm_root)
+                if config.projects:
+                    projects = [p for p in projects if p in config.projects]
+                for project in projects:
+                    proj_root = os.path.join(prgm_root, project)
+                    rows = diff(proj_root, earlier, later)
+                    if opts.summary:
+                        counts = dict()
+                        for status, group, _, _ in rows:
+                            counts.setdefault(group, Counter())[status] += 1
+                        for group in sorted(counts):
+                            writer.writerow([project, group] +
+                                            [counts[group][s] for s in STATUSES])
+                    else:
+                        for row in rows:
+                            writer.writerow([row[0], project] + list(row[1:]))
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+# Kinds of difference reported, in the order of summary columns
+STATUSES = ['added', 'removed', 'changed']
+
+def diff_mirror(proj_root, earlier, later):
+    '''Generate (status, data_category, uuid, file_name) for each file of a
+    mirrored project which was added, removed or changed (in content or
+    metadata) between two datestamps.  A datestamp on which the project was
+    not mirrored stands for the latest earlier one on which it was (see
+    _project_datestamp).'''
+    old = _index_rows(proj_root, earlier)
+    new = _index_rows(proj_root, later)
+    for uuid, a, b in common.merge_sorted(old, new):
+        if a is None:
+            yield 'added', b[2], uuid, b[4]
+        elif b is None:
+            yield 'removed', a[2], uuid, a[4]
+        elif a[5] != b[5]:
+            yield 'changed', b[2], uuid, b[4]
+
+def _index_rows(proj_root, datestamp):
+    datestamp = _project_datestamp(proj_root, datestamp,
+                                   lambda d: meta.has_metadata(proj_root, d))
+    if datestamp is None:
+        return iter([])
+    return meta.metadata_index(proj_root, datestamp)
+
+def _project_datestamp(proj_root, datestamp, has_data):
+    '''Return the latest datestamp of proj_root, no later than datestamp, for
+    which has_data(datestamp) is True.  As when dicing, data of a project
+    not mirrored (or diced) on a date are carried forward from an earlier
+    date, so are not reported as removed then added back.  Returns None if
+    the project has no such data, i.e. it was first mirrored later.'''
+    meta_dir = os.path.join(proj_root, "metadata")
+    if not os.path.isdir(meta_dir):
+        return None
+    stamps = sorted((d for d in os.listdir(meta_dir)
+                     if DATESTAMP_REGEX.match(d) and d <= datestamp),
+                    reverse=True)
+    for stamp in stamps:
+        if has_data(stamp):
+            return stamp
+    return None
+
+def diff_dice(proj_root, earlier, later):
+    '''Generate (status, annotation, sample, file_name) for each sample of a
+    diced project whose data of some annotation were added, removed or
+    changed (diced from another file) between two datestamps.  As with
+    diff_mirror, earlier data stand for a datestamp the project lacks.'''
+    old = _diced_samples(proj_root, earlier)
+    new = _diced_samples(proj_root, later)
+    for key, a, b in common.merge_sorted(old, new):
+        annotation, sample = key
+        if a is None:
+            yield 'added', annotation, sample, ",".join(b[1])
+        elif b is None:
+            yield 'removed', annotation, sample, ",".join(a[1])
+        elif a[1] != b[1]:
+            yield 'changed', annotation, sample, ",".join(b[1])
+
+def _diced_samples(proj_root, datestamp):
+    '''Generate ((annotation, sample), file_names) from the diced metadata of
+    a project, sorted by annotation then sample.  The diced metadata holds
+    one (short) row per diced file, so it is simply sorted in memory.'''
+    datestamp = _project_datestamp(proj_root, datestamp,
+                    lambda d: os.path.isfile(_diced_metadata(proj_root, d)))
+    if datestamp is None:
+        return
+    path = _diced_metadata(proj_root, datestamp)
+    with open(path) as f:
+        rows = sorted((r['annotation'], r['tcga_barcode'],
+                       os.path.basename(r['file_name']))
+                      for r in csv.DictReader(f, delimiter='\t'))
+    for key, group in groupby(rows, lambda r: r[:2]):
+        yield key, tuple(r[2] for r in group)
+
+def _diced_metadata(proj_root, datestamp):
+    project = os.path.basename(proj_root)
+    return os.path.join(proj_root, "metadata", datestamp,
+                        ".".join([project, datestamp, "diced_metadata", "tsv"]))
+
+def main():
+    gdc_diff().execute()
+
+if __name__ == "__main__":
+    main()
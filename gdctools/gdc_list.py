@@ -14,6 +14,7 @@ gdc_list: List data available in the GDC
 # }}}
 
 from __future__ import print_function
+import sys
 import json
 from collections import defaultdict
 
@@ -45,7 +46,10 @@ class gdc_list(GDCtool):
                          help='return at most this many results')
 
         cli.add_argument('-s', '--page-size', default=500, type=int,
-                         help='Server page size')
+                         help='Server page size (0 = choose automatically)')
+
+        cli.add_argument('-j', '--page-workers', default=1, type=int,
+                         help='Fetch result pages with this many threads')
 
         #Optional overrides of config file
         cli.add_argument('endpoint', help='Which endpoint to query/list')
@@ -78,7 +82,10 @@ class gdc_list(GDCtool):
                          filters=params['filters'],
                          fields=params['fields'],
                          expand=params['expand'])
-        print(json.dumps(query.get(), indent=2))
+        hits = query.iter_hits(page_size=self.options.page_size,
+                               to_idx=self.options.num_results,
+                               workers=self.options.page_workers)
+        print_json_list(hits)
 
 def filter_params(filters):
     '''Builds a dictionary of filters passed as 'key=value' pairs'''
@@ -98,6 +105,16 @@ def filter_params(filters):
     else:
         return and_filter(eq_filters)
 
+def print_json_list(items):
+    '''Print items as an indented JSON list, one item at a time, so that
+    output begins before the entire list has been retrieved'''
+    separator = '[\n'
+    for item in items:
+        text = json.dumps(item, indent=2)
+        sys.stdout.write(separator + '  ' + text.replace('\n', '\n  '))
+        separator = ',\n'
+    print('[]' if separator == '[\n' else '\n]')
+
 def main():
     gdc_list().execute()
 
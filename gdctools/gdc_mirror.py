@@ -18,12 +18,23 @@ import sys
 import os
 import logging
 import time
+import threading
 import json
+from timeit import default_timer as timer
+import calendar
+# Imported up front: the first time.strptime() call imports it, which is not
+# thread-safe in Python 2, and projects may be mirrored concurrently
+import _strptime
+from contextlib import closing, contextmanager
+from multiprocessing.pool import ThreadPool
 
 from GDCcore import *
 from GDCtool import GDCtool
 import lib.api as api
 import lib.meta as meta
+import lib.throttle as throttle
+import lib.manifest as manifest
+import lib.store as store
 import lib.common as common
 
 class gdc_mirror(GDCtool):
@@ -47,6 +58,48 @@ class gdc_mirror(GDCtool):
         cli.add_argument('-f', '--force-download', action='store_true',
                         help='Download files even if already mirrored locally.'+
                              ' (DO NOT use during incremental mirroring)')
+        cli.add_argument('-j', '--jobs', type=int,
+                        help='Download this many files in parallel')
+        cli.add_argument('--project-jobs', type=int, metavar='N',
+                        help='Mirror this many projects at once, sharing the '+
+                             'download threads given by --jobs')
+        cli.add_argument('--schedule', choices=SCHEDULES,
+                        help='Order in which files are downloaded: as their '+
+                             'metadata arrives (stream, the default), '+
+                             'smallest first, or largest first')
+        cli.add_argument('-b', '--bulk', type=int, metavar='N',
+                        help='Download small files N at a time, as tar.gz '+
+                             'archives from the GDC bulk data endpoint')
+        cli.add_argument('-i', '--incremental', action='store_true',
+                        help='Retrieve metadata only for files updated since '+
+                             'the previous mirror, and merge it into the '+
+                             'previous metadata')
+        cli.add_argument('--metadata-profile', choices=['full', 'slim'],
+                        help='Which fields of file metadata to retrieve: '+
+                             'everything (full, the default) or only those '+
+                             'used by GDCtools (slim)')
+        cli.add_argument('--measure-profiles', action='store_true',
+                        help='Instead of mirroring, report the size per file '+
+                             'of the metadata retrieved with each profile')
+        cli.add_argument('--verify', action='store_true',
+                        help='Instead of mirroring, check the mirrored files '+
+                             'against their .md5 files, in parallel, and '+
+                             'report problems in a TSV file')
+        cli.add_argument('--store', metavar='DIR',
+                        help='Keep one copy of each mirrored file in this '+
+                             'content-addressed store (on the same file '+
+                             'system as the mirror), hardlinked into the mirror')
+        cli.add_argument('--gc-store', action='store_true',
+                        help='Instead of mirroring, remove the files of the '+
+                             'store which are no longer linked into the mirror')
+        cli.add_argument('--rebuild-manifest', action='store_true',
+                        help='Instead of mirroring, recreate the manifest '+
+                             'index of each program from the files and '+
+                             'metadata already mirrored')
+        cli.add_argument('--combined-query', action='store_true',
+                        help='Retrieve metadata for all data categories of a '+
+                             'project with a single query, instead of one '+
+                             'query per category')
 
         # detect if we have curl installed
         self.has_cURL = api.curl_exists()
@@ -64,6 +117,77 @@ class gdc_mirror(GDCtool):
         self.force_download = opts.force_download
         self.workflow_type = opts.workflow_type
 
+        # Metadata queries may fetch their result pages concurrently
+        if config.page_workers:
+            api.GDCQuery.PAGE_WORKERS = int(config.page_workers)
+
+        # Number of files to download in parallel
+        if opts.jobs: config.jobs = opts.jobs
+        self.jobs = int(config.jobs) if config.jobs else 1
+
+        # Number of projects mirrored concurrently, each with its own metadata
+        # queries and download queue, but sharing the download threads
+        if opts.project_jobs: config.project_jobs = opts.project_jobs
+        self.project_jobs = int(config.project_jobs) if config.project_jobs \
+                            else 1
+
+        # Bytes read at a time by downloads (larger is faster, to a point)
+        if config.chunk_size:
+            self.chunk_size = int(config.chunk_size)
+        else:
+            self.chunk_size = api.DOWNLOAD_CHUNK_SIZE
+
+        # Small files may be downloaded in batches, from the bulk endpoint
+        if opts.bulk is not None: config.bulk = opts.bulk
+        self.bulk = int(config.bulk) if config.bulk else 0
+        if config.bulk_max_size:
+            self.bulk_max_size = int(config.bulk_max_size)
+        else:
+            self.bulk_max_size = BULK_MAX_SIZE
+
+        # With a recent cURL, other files may be downloaded many at a time
+        # by one cURL process, instead of one process per file
+        self.curl_batch = int(config.curl_batch) if config.curl_batch else 0
+        if self.curl_batch > 1 and not (self.has_cURL and
+                                        api.curl_supports_parallel()):
+            logging.warning("cURL --parallel unavailable, ignoring CURL_BATCH")
+            self.curl_batch = 0
+
+        # Downloads queued by the project being mirrored in this thread: a
+        # _DownloadPool (.downloads) and the batches of files being queued,
+        # indexed by kind ('bulk' or 'curl') (.batches)
+        self.queue = threading.local()
+
+        # Order in which queued files are downloaded
+        if opts.schedule: config.schedule = opts.schedule
+        if not config.schedule: config.schedule = 'stream'
+        if config.schedule not in SCHEDULES:
+            raise ValueError("Unknown download schedule: " + config.schedule)
+
+        # Optional budget of bandwidth (bytes/sec, e.g. 20M) and concurrent
+        # connections shared by all downloads, where the rate may vary with
+        # the time of day, e.g. RATE_PROFILES: 08:00-20:00=5M, 20:00-08:00=0
+        if config.max_rate or config.max_connections or config.rate_profiles:
+            rate = throttle.parse_rate(config.max_rate or 0)
+            connections = int(config.max_connections or 0)
+            profiles = throttle.parse_profiles(config.rate_profiles or '')
+            api.set_throttle(throttle.Throttle(rate, connections, profiles))
+
+            # Batched cURL transfers cannot be held to the shared rate limit
+            if self.curl_batch and api.get_throttle().limits_rate():
+                logging.info("Rate limit in effect, ignoring CURL_BATCH")
+                self.curl_batch = 0
+
+        # Size of the keep-alive connection pool shared by queries & downloads,
+        # which must be large enough for each download thread to hold one,
+        # along with the metadata query of each concurrent project
+        pool_size = int(config.http_pool_size) if config.http_pool_size else 0
+        connections = self.jobs
+        if self.project_jobs > 1:
+            connections += self.project_jobs
+        if pool_size or connections > 1:
+            api.set_pool_size(max(pool_size, connections))
+
         if config.legacy:
             # Legacy mode has been requested in config file, coerce to boolean
             value = config.legacy.lower()
@@ -83,12 +207,57 @@ class gdc_mirror(GDCtool):
         #      ONLY supports MIRRORING of legacy, nothing else
         api.set_legacy(config.legacy)
 
+        # Smaller metadata field profiles make for faster queries
+        if opts.metadata_profile:
+            config.metadata_profile = opts.metadata_profile
+        if config.metadata_profile:
+            api.set_file_profile(config.metadata_profile)
+
+        # Optionally query all data categories of a project at once
+        if config.combined_query:
+            value = config.combined_query.lower()
+            config.combined_query = (value in ["1", "true", "on", "yes"])
+        if opts.combined_query:
+            config.combined_query = True
+
+        if config.incremental:
+            value = config.incremental.lower()
+            config.incremental = (value in ["1", "true", "on", "yes"])
+        if opts.incremental:
+            config.incremental = True
+
+        # Optionally write compact, gzipped metadata alongside the JSON
+        if config.compact_metadata:
+            value = config.compact_metadata.lower()
+            config.compact_metadata = (value in ["1", "true", "on", "yes"])
+
+        # Metadata may be stored as the changes since the previous mirror,
+        # with a full copy after at most this many deltas (0: always full)
+        self.metadata_deltas = int(config.metadata_deltas or 0)
+
+        # Optional content-addressed store, of which mirrored files are
+        # hardlinks, so that identical files are stored & downloaded once
+        if opts.store: config.store = opts.store
+        self.store = store.ObjectStore(config.store) if config.store else None
+
     def mirror(self):
 
         config = self.config
         projects = []
         programs = []
 
+        if self.options.rebuild_manifest:
+            self.rebuild_manifests()
+            return
+
+        if self.options.verify:
+            self.verify()
+            return
+
+        if self.options.gc_store:
+            self.gc_store()
+            return
+
         # Validate program and project names, if specified
         if config.projects:
             all_projects = api.get_projects()
@@ -116,6 +285,10 @@ class gdc_mirror(GDCtool):
         # Everything has validated, so let's get mirroring started
         if not os.path.isdir(config.mirror.dir):
             os.makedirs(config.mirror.dir)
+        if self.store and not self.store.same_file_system(config.mirror.dir):
+            logging.warning("Store %s is not on the file system of the mirror, "
+                            "ignoring it" % self.store.root)
+            self.store = None
 
         logging.info("GDC Mirror Version: %s", self.cli.version)
         logging.info("Command: " + " ".join(sys.argv))
@@ -130,72 +303,452 @@ class gdc_mirror(GDCtool):
                               prgm, ",".join(projects_for_this_program)))
                 projects.extend(projects_for_this_program)
 
-        # Make list of which projects belong to each program
+        # Resolve program & data categories of every project in one query,
+        # then make list of which projects belong to each program
+        self.project_info = api.get_projects_info(projects)
         program_projects = dict()
         for project in projects:
-            prgm = api.get_program(project)
+            if project not in self.project_info:
+                raise ValueError("No project matched '" + project + "'")
+            prgm = self.project_info[project]['program']
             if prgm not in program_projects: program_projects[prgm] = []
             program_projects[prgm].append(project)
 
-        # Now loop over each program, acquiring lock
-        for prgm in program_projects:
-            projects = program_projects[prgm]
-            prgm_root = os.path.abspath(os.path.join(config.mirror.dir, prgm))
+        if self.options.measure_profiles:
+            self.measure_profiles(projects)
+            return
 
-            with common.lock_context(prgm_root, "mirror"):
-                for project in sorted(projects):
-                    self.mirror_project(prgm, project)
+        # Now acquire the lock of every program, then mirror the projects of
+        # all programs, PROJECT_JOBS at a time.  Downloads are performed by
+        # one pool of JOBS threads, shared by all projects
+        self.workers = ThreadPool(self.jobs) if self.jobs > 1 else None
+        self.throughput = _Throughput()
+        self.manifests = dict()
+        self.snapshots = dict()
+        prgm_roots = [os.path.abspath(os.path.join(config.mirror.dir, prgm))
+                      for prgm in sorted(program_projects)]
+        tasks = [(prgm, project) for prgm in sorted(program_projects)
+                 for project in sorted(program_projects[prgm])]
+        try:
+            with _mirror_locks(prgm_roots):
+                for prgm, prgm_root in zip(sorted(program_projects),
+                                           prgm_roots):
+                    self.manifests[prgm] = manifest.Manifest(prgm_root)
+                if self.project_jobs > 1 and len(tasks) > 1:
+                    projects = ThreadPool(min(self.project_jobs, len(tasks)))
+                    try:
+                        failed = projects.map(self.__mirror_task, tasks, 1)
+                    finally:
+                        projects.close()
+                        projects.join()
+                else:
+                    failed = [self.__mirror_task(task) for task in tasks]
+        finally:
+            if self.workers is not None:
+                self.workers.close()
+                self.workers.join()
+            for index in self.manifests.values():
+                index.close()
 
-        # Update the datestamps file with this version of the mirror
+        # A failed project does not stop the others, but this version of the
+        # mirror is only recorded in the datestamps file if all succeeded
+        failed = [project for project in failed if project]
+        if failed:
+            raise RuntimeError("Mirroring failed for %d project(s): %s" % \
+                               (len(failed), ", ".join(failed)))
         self.update_datestamps_file()
         logging.info("Mirror completed successfully.")
 
-    def __mirror_file(self, file_d, proj_root, n, total, retries=3):
+    def __mirror_task(self, task):
+        '''Mirror one (program, project) pair, with a download queue of its
+        own.  Returns None on success, or the project name if it failed.'''
+        prgm, project = task
+        # What was already mirrored is read with one scan of each folder
+        proj_root = os.path.join(self.config.mirror.dir, prgm, project)
+        self.snapshots[proj_root] = meta.MirrorSnapshot(proj_root,
+                                                not self.config.mirror.legacy)
+        self.queue.downloads = _DownloadPool(self.jobs,
+                                             self.config.mirror.schedule,
+                                             self.workers)
+        self.queue.batches = dict()
+        try:
+            self.mirror_project(prgm, project)
+        except Exception:
+            logging.exception("Mirroring of %s FAILED:" % project)
+            return project
+        finally:
+            self.queue.batches = dict()
+            self.queue.downloads.close()
+            del self.snapshots[proj_root]
+        return None
+
+    def rebuild_manifests(self):
+        '''Recreate the manifest of each program in the mirror (or of each
+        program given in the config file or command line)'''
+        config = self.config
+        mirror_dir = config.mirror.dir
+        programs = config.programs or common.immediate_subdirs(mirror_dir)
+        strict = not config.mirror.legacy
+        for prgm in programs:
+            prgm_root = os.path.abspath(os.path.join(mirror_dir, prgm))
+            if not os.path.isdir(prgm_root):
+                logging.warning("No mirror of " + prgm + " in " + mirror_dir)
+                continue
+            with common.lock_context(prgm_root, "mirror"):
+                index = manifest.Manifest(prgm_root)
+                try:
+                    count = index.rebuild(strict)
+                finally:
+                    index.close()
+            gprint("%s: %d mirrored files recorded in %s" % (prgm, count,
+                                                            index.path))
+
+    def gc_store(self):
+        '''Remove the objects of the store no longer linked into the mirror,
+        e.g. after old datestamps of it have been deleted.  Every program of
+        the mirror is locked meanwhile; other mirrors sharing the store must
+        not be running.'''
+        if self.store is None:
+            gabort(1, "No store given (STORE in config file or --store)")
+        mirror_dir = self.config.mirror.dir
+        prgm_roots = [os.path.abspath(os.path.join(mirror_dir, prgm))
+                      for prgm in common.immediate_subdirs(mirror_dir)]
+        with _mirror_locks(prgm_roots):
+            count, size = self.store.gc()
+        gprint("%d unreferenced files (%d bytes) removed from %s" % \
+               (count, size, self.store.root))
+
+    def verify(self):
+        '''Check that the files listed in the latest metadata of each mirrored
+        project are present, with the MD5 digests recorded in their .md5
+        files (or, lacking those, in the metadata).  Files are hashed by
+        JOBS threads; digests are cached in the manifest, keyed by inode,
+        size and mtime, so unchanged files are not hashed again.  Problems
+        are written to <program>/verify.<datestamp>.tsv, as rows of
+            project  file_id  path  status  expected_md5  actual_md5
+        where status is one of missing, mismatch or no_md5 (no .md5 file).
+        '''
+        config = self.config
+        mirror_dir = config.mirror.dir
+        programs = config.programs or common.immediate_subdirs(mirror_dir)
+        strict = not config.mirror.legacy
+        pool = ThreadPool(self.jobs)
+        try:
+            for prgm in programs:
+                prgm_root = os.path.abspath(os.path.join(mirror_dir, prgm))
+                if not os.path.isdir(prgm_root):
+                    logging.warning("No mirror of " + prgm + " in " + mirror_dir)
+                    continue
+                projects = common.immediate_subdirs(prgm_root)
+                if config.projects:
+                    projects = [p for p in projects if p in config.projects]
+
+                with common.lock_context(prgm_root, "mirror"), \
+                     closing(manifest.Manifest(prgm_root)) as index:
+                    checks = []
+                    for project in sorted(projects):
+                        proj_root = os.path.join(prgm_root, project)
+                        stamp = meta.latest_datestamp(proj_root)
+                        if stamp is None:
+                            continue
+                        stamp_dir = os.path.join(proj_root, "metadata", stamp)
+                        for file_d in meta.latest_metadata(stamp_dir):
+                            path = meta.mirror_path(proj_root, file_d, strict)
+                            checks.append((index, project, file_d, path))
+
+                    report = os.path.join(prgm_root, ".".join(["verify",
+                                                    self.datestamp, "tsv"]))
+                    problems = 0
+                    with open(report, 'w') as rf:
+                        rf.write("\t".join(VERIFY_COLUMNS) + "\n")
+                        for row in pool.imap(_verify_file, checks, 16):
+                            if row is not None:
+                                rf.write("\t".join(row) + "\n")
+                                problems += 1
+                gprint("%s: %d files checked, %d problems reported in %s" % \
+                       (prgm, len(checks), problems, report))
+        finally:
+            pool.close()
+            pool.join()
+
+    def measure_profiles(self, projects):
+        '''Report the metadata bytes per file retrieved with each field
+        profile, for each data category of each project'''
+        data_categories = self.config.mirror.data_categories
+        for project in sorted(projects):
+            categories = data_categories
+            if not categories:
+                categories = self.project_info[project]['data_categories']
+            for category in sorted(categories):
+                sizes = api.measure_file_profiles(project, category)
+                for profile in sorted(sizes):
+                    decoded, transferred = sizes[profile]
+                    gprint("%s\t%s\t%s\t%.0f bytes/file\t(%.0f transferred)" % \
+                           (project, category, profile, decoded, transferred))
+
+    def __queue_file(self, file_d, proj_root, n, total=None):
+        '''Submit a file for mirroring by the download pool, returning an
+        object whose get() method returns the result of __mirror_file.
+
+        Progress is logged here, by the submitting thread, so that it remains
+        in order even when files are downloaded in parallel.  The total
+        number of files to mirror may be unknown (None) while metadata is
+        still streaming.
+        '''
+        strict = not self.config.mirror.legacy
+        basename = meta.file_basename(file_d, strict)
+        if total is None:
+            logging.info("Mirroring file {0} | {1}".format(basename, n))
+        else:
+            logging.info("Mirroring file {0} | {1} of {2}".format(basename,
+                                                                 n, total))
+        file_size = file_d.get('file_size')
+        kind = self.__batch_kind(file_d)
+        if kind:
+            batch = self.queue.batches.setdefault(kind, _Batch())
+            batch.files.append((file_d, proj_root))
+            if len(batch.files) >= (self.bulk if kind == 'bulk'
+                                    else self.curl_batch):
+                self.__flush_batch(kind)
+            return _BatchMember(batch, file_d['file_id'])
+
+        return self.queue.downloads.submit(self.__mirror_file, file_d,
+                                           proj_root, size=file_size)
+
+    def __batch_kind(self, file_d):
+        '''Return how file_d should be downloaded along with other files:
+        via the bulk endpoint ('bulk'), by a shared cURL process ('curl'),
+        or not at all (None)'''
+        file_size = file_d.get('file_size')
+        if self.bulk > 1 and file_size and file_size <= self.bulk_max_size:
+            return 'bulk'
+        if self.curl_batch > 1:
+            return 'curl'
+        return None
+
+    def __flush_batch(self, kind):
+        '''Submit the files queued for batch download as one job'''
+        batch = self.queue.batches.pop(kind, None)
+        if batch and batch.files:
+            size = sum(file_d.get('file_size') or 0 for file_d, _ in batch.files)
+            batch.result = self.queue.downloads.submit(self.__mirror_batch,
+                                                       batch.files, kind,
+                                                       size=size)
+
+    def __wait_downloads(self):
+        '''Wait for all queued files, including partially filled batches'''
+        for kind in list(self.queue.batches):
+            self.__flush_batch(kind)
+        self.queue.downloads.wait()
+
+    def __mirror_batch(self, files, kind):
+        '''Mirror a list of (file_d, proj_root) pairs with a single bulk
+        request (kind 'bulk') or cURL process (kind 'curl'), falling back to
+        downloading individually any files which were not delivered intact.
+        Returns a dict mapping the uuid of each file to the result of
+        mirroring it, as __mirror_file.
+        '''
+        strict = not self.config.mirror.legacy
+        mirrored = dict()
+        needed = []
+        save_paths = dict()
+        proj_roots = dict()
+        for file_d, proj_root in files:
+            uuid = file_d['file_id']
+            index = self.__manifest(proj_root)
+            if not self.force_download and index.is_mirrored(file_d):
+                mirrored[uuid] = False
+                continue
+            savepath = meta.mirror_path(proj_root, file_d, strict=strict)
+            if (self.force_download or
+                    not self.__on_disk(file_d, proj_root, savepath)):
+                common.safeMakeDirs(os.path.dirname(savepath))
+                if self.__from_store(file_d, proj_root, savepath):
+                    mirrored[uuid] = True
+                    continue
+                if self.force_download:
+                    common.silent_rm(savepath + api.PARTIAL_SUFFIX)
+                needed.append(file_d)
+                save_paths[uuid] = savepath
+                proj_roots[uuid] = proj_root
+            else:
+                mirrored[uuid] = False
+
+        if len(needed) > 1:
+            failed = dict()
+            started = timer()
+            try:
+                if kind == 'bulk':
+                    total = sum(fd.get('file_size') or 0 for fd in needed)
+                    verified = api.bulk_download_files(needed, save_paths,
+                                max_time=self.throughput.timeout(total))
+                else:
+                    # Each batch occupies one of the JOBS download workers,
+                    # so its transfers run one at a time (over one reused
+                    # connection), lest JOBS batches make JOBS**2 transfers
+                    largest = max(fd.get('file_size') or 0 for fd in needed)
+                    verified, failed = api.curl_download_files(needed,
+                                save_paths, parallel=1,
+                                max_time=self.throughput.timeout(largest))
+                    self.throughput.record(sum(v[1] for v in verified.values()),
+                                           timer() - started)
+            except Exception as e:
+                logging.warning("Batch download of %d files failed: %s\n"
+                                "Downloading them individually..." % \
+                                (len(needed), str(e)))
+                verified = dict()
+
+            for uuid in sorted(failed):
+                logging.warning("Download of %s failed: %s" % (uuid,
+                                                               failed[uuid]))
+            for uuid, (md5sum, size) in verified.items():
+                self.__save(proj_roots[uuid], uuid, save_paths[uuid], size,
+                            md5sum)
+                mirrored[uuid] = True
+
+        for file_d, proj_root in files:
+            if file_d['file_id'] not in mirrored:
+                mirrored[file_d['file_id']] = self.__mirror_file(file_d,
+                                                                 proj_root)
+        return mirrored
+
+    def __mirror_file(self, file_d, proj_root, retries=3):
         '''Mirror a file into <proj_root>/<cat>/<type>.
 
-        Files are uniquely identified by uuid.
+        Files are uniquely identified by uuid.  Returns True if the file was
+        downloaded, or False if an up-to-date copy was already mirrored or
+        it could not be downloaded.
+        This may be called concurrently from several download threads.
         '''
         strict = not self.config.mirror.legacy
+        # Files recorded in the manifest need not be looked for on disk
+        index = self.__manifest(proj_root)
+        if not self.force_download and index.is_mirrored(file_d):
+            return False
+
         savepath = meta.mirror_path(proj_root, file_d, strict=strict)
         dirname, basename = os.path.split(savepath)
-        logging.info("Mirroring file {0} | {1} of {2}".format(basename, n, total))
 
-        #Ensure <root>/<cat>/<type>/ exists
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+        #Ensure <root>/<cat>/<type>/ exists (another thread may be racing)
+        common.safeMakeDirs(dirname)
 
         md5path = savepath + ".md5"
 
         # Download if force is enabled or if the file is not on disk
-        if (self.force_download or not meta.md5_matches(file_d, md5path, strict)
-                or not os.path.isfile(savepath)):
+        if self.force_download or not self.__on_disk(file_d, proj_root,
+                                                     savepath):
+
+            # Files whose bytes are already stored need not be downloaded
+            if self.__from_store(file_d, proj_root, savepath):
+                return True
 
-            # New file, mirror to this folder
+            # Interrupted downloads are resumed from <savepath>.part, unless
+            # the user asked for a fresh copy
+            if self.force_download:
+                common.silent_rm(savepath + api.PARTIAL_SUFFIX)
+
+            # New file, mirror to this folder.  Each download is hashed as
+            # it arrives, and rejected if it does not match the GDC md5sum
+            file_size = file_d.get('file_size')
+            md5sum = file_d['md5sum']
+            # Allow time in proportion to the file size, at the throughput
+            # observed so far, doubling it after each failure
+            time = self.throughput.timeout(file_size)
             while retries > 0:
                 try:
-                    time = 180
                     #Download file
                     uuid = file_d['file_id']
+                    started = timer()
                     if self.has_cURL:
-                        api.curl_download_file(uuid, savepath, max_time=time)
+                        verified = api.curl_download_file(uuid, savepath,
+                                                max_time=time,
+                                                file_size=file_size,
+                                                md5sum=md5sum,
+                                                chunk_size=self.chunk_size)
                     else:
-                        api.py_download_file(uuid, savepath)
+                        verified = api.py_download_file(uuid, savepath,
+                                                chunk_size=self.chunk_size,
+                                                file_size=file_size,
+                                                md5sum=md5sum,
+                                                max_time=time)
+                    self.throughput.record(verified[1], timer() - started)
                     break
+                except api.ChecksumError as e:
+                    logging.warning(str(e) + '\nRetrying...')
+                    retries = retries - 1
                 except Exception as e:
                     logging.warning("Download failed: " + str(e) +'\nRetrying...')
                     retries = retries - 1
-                    # Give some more time, in case the file is large...
-                    # TODO: is this worth it?
-                    time += 180
+                    # Give some more time, in case the network has slowed
+                    time *= 2
 
             if retries == 0:
                 logging.error("Error downloading file {0}, too many retries ({1})".format(savepath, retries))
+                return False
             else:
-                #Save md5 checksum on success
-                md5sum = file_d['md5sum']
-                md5path = savepath + ".md5"
-                with open(md5path, 'w') as mf:
-                    mf.write(md5sum + "  " + basename)
+                #Save the verified md5 checksum and size on success
+                md5sum, size = verified
+                self.__save(proj_root, file_d['file_id'], savepath, size,
+                            md5sum)
+            return True
+
+        # Mirrored before the manifest existed, so when is unknown
+        index.record_from_disk(os.path.basename(proj_root), file_d, savepath,
+                               None, strict, self.snapshots.get(proj_root))
+        return False
+
+    def __on_disk(self, file_d, proj_root, savepath):
+        '''Return True if file_d is mirrored at savepath, with a matching .md5
+        file, as seen by the snapshot of its project (if any)'''
+        strict = not self.config.mirror.legacy
+        snapshot = self.snapshots.get(proj_root)
+        if not meta.md5_matches(file_d, savepath + ".md5", strict, snapshot):
+            return False
+        return snapshot is not None or os.path.isfile(savepath)
+
+    def __save(self, proj_root, uuid, savepath, size, md5sum):
+        '''Keep a verified download: write its .md5 file, add it to the store
+        (if any) and record it in the manifest'''
+        meta.write_md5_file(savepath + ".md5", md5sum,
+                            os.path.basename(savepath), size)
+        if self.store is not None:
+            try:
+                self.store.add(savepath, md5sum)
+            except (OSError, IOError) as e:
+                logging.warning("Could not store %s: %s" % (savepath, str(e)))
+        self.__record(proj_root, uuid, savepath, size, md5sum)
+
+    def __from_store(self, file_d, proj_root, savepath):
+        '''Mirror file_d as a link to the stored file with its md5sum (and
+        size), if there is one.  Returns True if it was mirrored.  Stored
+        files are not re-hashed, so when downloads are forced nothing is
+        linked from the store, and each download replaces what is stored
+        (which is how damaged files are repaired).'''
+        if self.store is None or self.force_download:
+            return False
+        md5sum = file_d['md5sum']
+        size = self.store.size(md5sum)
+        if size is None or file_d.get('file_size') not in (None, size):
+            return False
+        try:
+            self.store.link(md5sum, savepath)
+        except Exception as e:
+            logging.warning("Could not link %s from store: %s" % (savepath,
+                                                                  str(e)))
+            return False
+        logging.info("Linked %s from store" % os.path.basename(savepath))
+        self.__save(proj_root, file_d['file_id'], savepath, size, md5sum)
+        return True
+
+    def __record(self, proj_root, uuid, savepath, size, md5sum):
+        '''Record a newly downloaded file in the manifest'''
+        self.__manifest(proj_root).record(os.path.basename(proj_root), uuid,
+                                          savepath, size, md5sum,
+                                          self.datestamp)
+
+    def __manifest(self, proj_root):
+        '''Return the manifest of the program containing proj_root'''
+        return self.manifests[os.path.basename(os.path.dirname(proj_root))]
 
     def mirror_project(self, program, project):
         '''Mirror one project folder'''
@@ -208,7 +761,7 @@ class gdc_mirror(GDCtool):
         if not data_categories:
             logging.info("No data_categories specified, using GDC API to " + \
                          "discover ALL available categories")
-            data_categories = api.get_data_categories(project)
+            data_categories = list(self.project_info[project]['data_categories'])
 
         logging.info("Using %d data categories: %s" % \
                      (len(data_categories), ",".join(data_categories)))
@@ -218,17 +771,53 @@ class gdc_mirror(GDCtool):
         # Read the previous metadata, if present
         prev_datestamp = meta.latest_datestamp(proj_dir, None)
         prev_metadata = []
+        prev_sync = None
         if prev_datestamp is not None:
             prev_stamp_dir = os.path.join(proj_dir, "metadata", prev_datestamp)
             prev_metadata = meta.latest_metadata(prev_stamp_dir)
+            prev_sync = meta.read_sync_record(prev_stamp_dir, project,
+                                              prev_datestamp)
+
+        # Index files mirrored before the manifest existed
+        index = self.manifests[program]
+        if prev_metadata and not index.entries(project):
+            logging.info("Recording previously mirrored files of " + project +
+                         " in manifest")
+            index.rebuild_project(project, not config.legacy)
 
-        # Mirror each category separately, recording metadata (file dicts)
+        # Incremental syncing is only valid if the previous mirror selected
+        # exactly the same files from GDC as this one would
+        scope = { 'data_categories' : sorted(data_categories),
+                  'workflow_type' : self.workflow_type,
+                  'cases' : sorted(self.config.cases),
+                  'legacy' : bool(config.legacy),
+                  'metadata_profile' : api.get_file_profile() }
+        sync_time = time.time()
+        removed = []
+
+        # Mirror each category, recording metadata (file dicts); either all
+        # at once with a single query, or separately with one query apiece
         file_metadata = []
-        for cat in sorted(data_categories):
-            cat_data = self.mirror_category(program, project, cat,
-                                            self.workflow_type,
-                                            prev_metadata)
-            file_metadata.extend(cat_data)
+        incremental = config.incremental and not self.force_download
+        if incremental and prev_sync and prev_sync.get('scope') == scope:
+            file_metadata, removed = self.sync_categories(program, project,
+                                                          sorted(data_categories),
+                                                          prev_metadata,
+                                                          prev_sync)
+        elif config.combined_query:
+            file_metadata = self.mirror_categories(program, project,
+                                                   sorted(data_categories),
+                                                   self.workflow_type,
+                                                   prev_metadata)
+        else:
+            if incremental:
+                logging.info("No compatible previous sync of " + project +
+                             ", retrieving all metadata")
+            for cat in sorted(data_categories):
+                cat_data = self.mirror_category(program, project, cat,
+                                                self.workflow_type,
+                                                prev_metadata)
+                file_metadata.extend(cat_data)
 
         # Record project-level metadata
         # file dicts, counts, redactions, blacklist, etc.
@@ -237,57 +826,161 @@ class gdc_mirror(GDCtool):
         if not os.path.isdir(stamp_folder):
             os.makedirs(stamp_folder)
 
-        # Write file metadata
-        meta_json = ".".join(["metadata", project, datestamp, "json" ])
-        meta_json = os.path.join(stamp_folder, meta_json)
-        with open(meta_json, 'w') as jf:
-            json.dump(file_metadata, jf, indent=2)
+        # Write file metadata: in full, optionally with a compact companion
+        # which is much quicker to read back, or as the changes since the
+        # previous mirror
+        meta.write_project_metadata(proj_dir, datestamp, file_metadata,
+                                    prev_datestamp, self.metadata_deltas,
+                                    config.compact_metadata)
+
+        # Record when this metadata was retrieved, for the next incremental
+        # sync, along with the uuids of any files removed from GDC since
+        meta.write_sync_record(stamp_folder, project, datestamp,
+                               { 'sync_time' : _utc_isoformat(sync_time),
+                                 'scope' : scope,
+                                 'removed' : removed })
 
     def mirror_category(self, program, project, category,
                         workflow_type, prev_metadata):
         '''Mirror one category of data in a particular project.
         Return the mirrored file metadata.
         '''
+        return self.mirror_categories(program, project, [category],
+                                      workflow_type, prev_metadata)
+
+    def mirror_categories(self, program, project, categories,
+                          workflow_type, prev_metadata):
+        '''Mirror one or more categories of data in a particular project,
+        using a single files query for all of them.  Return the mirrored
+        file metadata, grouped by category in the order given.
+        '''
         proj_dir = os.path.join(self.config.mirror.dir, program, project)
-        cat_dir = os.path.join(proj_dir, category.replace(' ', '_'))
         strict = not self.config.mirror.legacy
 
-        # Create data folder
-        if not os.path.isdir(cat_dir):
-            logging.info("Creating folder: " + cat_dir)
-            os.makedirs(cat_dir)
+        # Create data folders
+        for category in categories:
+            cat_dir = os.path.join(proj_dir, category.replace(' ', '_'))
+            if not os.path.isdir(cat_dir):
+                logging.info("Creating folder: " + cat_dir)
+                os.makedirs(cat_dir)
 
         # If cases is a list, only files from these cases will be returned,
         # otherwise all files from the category will be
         cases = self.config.cases
-        file_metadata = api.get_project_files(project, category,
-                                              workflow_type, cases=cases)
-        
-        # Filter out extraneous cases from multi-case (e.g. MAF) file metadata
-        # if cases have been specified
-        if cases:
-            for idx, file_dict in enumerate(file_metadata):
-                if len(file_dict.get("cases", [])) > 1:
-                    file_metadata[idx]["cases"] = \
-                    [case for case in file_metadata[idx]["cases"] \
-                     if case["submitter_id"] in cases]
-
-        new_metadata = file_metadata
 
         # If we aren't forcing a full mirror, check the existing metadata
         # to see what files are new
+        mirrored = set()
         if not self.force_download:
-            new_metadata = meta.files_diff(proj_dir, file_metadata,
-                                           prev_metadata, strict)
+            mirrored = meta.mirrored_uuids(proj_dir, prev_metadata, strict,
+                                           self.manifests[program],
+                                           self.snapshots.get(proj_dir))
 
-        num_files = len(new_metadata)
-        logging.info("{0} new {1} files".format(num_files, category))
+        # File dicts are streamed from GDC, so that downloads begin while
+        # later pages of metadata are still arriving
+        cat_metadata = dict((category, []) for category in categories)
+        num_queued = dict((category, 0) for category in categories)
+        results = []
+        query_categories = categories[0] if len(categories) == 1 else categories
+        for file_dict in api.iter_project_files(project, query_categories,
+                                                workflow_type, cases=cases):
+            _filter_cases(file_dict, cases)
+            category = file_dict['data_category']
+            cat_metadata[category].append(file_dict)
 
-        for n, file_d in enumerate(new_metadata):
-            self.__mirror_file(file_d, proj_dir, n+1, num_files)
+            if file_dict['file_id'] not in mirrored:
+                num_queued[category] += 1
+                result = self.__queue_file(file_dict, proj_dir,
+                                           num_queued[category])
+                results.append((category, result))
 
+        # Only the files actually downloaded are new, not those which failed
+        self.__wait_downloads()
+        num_files = dict((category, 0) for category in categories)
+        for category, result in results:
+            if result.get():
+                num_files[category] += 1
+
+        file_metadata = []
+        for category in categories:
+            logging.info("{0} new {1} files".format(num_files[category],
+                                                    category))
+            file_metadata.extend(cat_metadata[category])
         return file_metadata
 
+    def sync_categories(self, program, project, categories, prev_metadata,
+                        prev_sync):
+        '''Incrementally mirror data categories of a project: retrieve full
+        metadata only for files updated since the previous sync, along with
+        the uuids of all current files (to detect removals), and merge them
+        into the previous metadata.  Return the merged file metadata and the
+        list of uuids removed from GDC since the previous sync.
+        '''
+        proj_dir = os.path.join(self.config.mirror.dir, program, project)
+        strict = not self.config.mirror.legacy
+        cases = self.config.cases
+        query_categories = categories[0] if len(categories) == 1 else categories
+
+        # Overlap syncs a little, to tolerate clock skew between us and GDC
+        since = _parse_utc_isoformat(prev_sync['sync_time']) - SYNC_OVERLAP
+        since = _utc_isoformat(since)
+        logging.info("Retrieving metadata of files updated since " + since)
+
+        current = set(api.get_project_file_ids(project, query_categories,
+                                               self.workflow_type, cases=cases))
+        prev_metadata = [fd for fd in prev_metadata
+                         if fd['data_category'] in categories]
+        removed = sorted(fd['file_id'] for fd in prev_metadata
+                         if fd['file_id'] not in current)
+        if removed:
+            logging.info("%d files removed from GDC since %s" % \
+                         (len(removed), prev_sync['sync_time']))
+
+        # Updated files are re-mirrored only if their md5 sums have changed
+        changed = []
+        results = []
+        for file_dict in api.iter_project_files(project, query_categories,
+                                                self.workflow_type, cases=cases,
+                                                updated_since=since):
+            _filter_cases(file_dict, cases)
+            changed.append(file_dict)
+            result = self.__queue_file(file_dict, proj_dir, len(changed))
+            results.append((file_dict['data_category'], result))
+
+        # Files whose download failed in an earlier run are not updated, so
+        # retry any of the previous files still missing from the mirror
+        updated = set(fd['file_id'] for fd in changed)
+        mirrored = meta.mirrored_uuids(proj_dir, prev_metadata, strict,
+                                       self.manifests[program],
+                                       self.snapshots.get(proj_dir))
+        missing = [fd for fd in prev_metadata
+                   if fd['file_id'] in current and
+                   fd['file_id'] not in updated and
+                   fd['file_id'] not in mirrored]
+        if missing:
+            logging.info("Retrying %d files not mirrored by earlier runs" % \
+                         len(missing))
+        for file_dict in missing:
+            result = self.__queue_file(file_dict, proj_dir, len(results) + 1)
+            results.append((file_dict['data_category'], result))
+
+        self.__wait_downloads()
+        num_files = dict((category, 0) for category in categories)
+        for category, result in results:
+            if result.get():
+                num_files[category] += 1
+
+        for category in categories:
+            logging.info("{0} new {1} files".format(num_files[category],
+                                                    category))
+
+        file_metadata = meta.merge_metadata(prev_metadata, changed, removed)
+        if len(file_metadata) != len(current):
+            logging.warning("Incremental sync of %s found %d files, but GDC "
+                            "reports %d; consider a full mirror" % \
+                            (project, len(file_metadata), len(current)))
+        return file_metadata, removed
+
     def execute(self):
         super(gdc_mirror, self).execute()
         self.parse_args()
@@ -302,15 +995,213 @@ class gdc_mirror(GDCtool):
 
         logging.info("Updating datestamps in " + datestamps_file)
 
-        # if it doesn't exist, create a blank one
-        if not os.path.isfile(datestamps_file):
-            open(datestamps_file, 'w')
+        # Mirrors of other programs may be finishing at the same time
+        datestamps_dir = os.path.dirname(os.path.abspath(datestamps_file))
+        with common.lock_context(datestamps_dir, "datestamps"):
+            # if it doesn't exist, create a blank one
+            if not os.path.isfile(datestamps_file):
+                open(datestamps_file, 'w').close()
+
+            # Now read the file
+            with open(datestamps_file, 'r+') as df:
+                stamps = df.read().strip().split('\n')
+                if stamps[-1] != self.datestamp:
+                    df.write(self.datestamp + '\n')
+
+class _DownloadPool(object):
+    '''Runs file downloads on a bounded pool of worker threads, or serially
+    in the calling thread if only one job is requested.
+
+    With the 'stream' schedule each download starts as soon as it is
+    submitted; otherwise downloads are held until wait() is called, then
+    started in order of size: smallest first (so that the most files are
+    mirrored soonest) or largest first (so that no worker is left with one
+    big file after the others have finished).
+
+    Several _DownloadPools may share the threads of one ThreadPool, given
+    as pool, which is then left open by close().
+    '''
+
+    def __init__(self, jobs=1, schedule='stream', pool=None):
+        self.shared = pool is not None
+        if not self.shared:
+            pool = ThreadPool(jobs) if jobs > 1 else None
+        self.pool = pool
+        self.schedule = schedule
+        self.pending = []
+        self.queued = []
+
+    def submit(self, func, *args, **kwargs):
+        '''Run func(*args), returning an object whose get() method returns
+        its result (or raises its exception).  The size keyword gives the
+        number of bytes to be downloaded, by which downloads are scheduled'''
+        if self.schedule != 'stream':
+            result = _DeferredResult(func, args, kwargs.get('size'))
+            self.queued.append(result)
+            return result
+        return self._start(func, args)
+
+    def wait(self):
+        '''Start any queued downloads, in the order of the schedule, then wait
+        for all submitted downloads, re-raising the first failure'''
+        queued, self.queued = self.queued, []
+        queued.sort(key=lambda d: d.size or 0,
+                    reverse=(self.schedule == 'largest'))
+        for deferred in queued:
+            deferred.result = self._start(deferred.func, deferred.args)
+
+        pending, self.pending = self.pending, []
+        for result in pending:
+            result.get()
+
+    def close(self):
+        if self.pool is not None and not self.shared:
+            self.pool.close()
+            self.pool.join()
+
+    def _start(self, func, args):
+        if self.pool is None:
+            result = _SerialResult(func, args)
+        else:
+            result = self.pool.apply_async(func, args)
+        self.pending.append(result)
+        return result
+
+class _Batch(object):
+    '''Files queued for download together, as (file_d, proj_root) pairs,
+    and once submitted the result of mirroring them'''
+    def __init__(self):
+        self.files = []
+        self.result = None
+
+class _BatchMember(object):
+    '''Result of mirroring one file of a download batch'''
+    def __init__(self, batch, uuid):
+        self.batch = batch
+        self.uuid = uuid
+
+    def get(self):
+        return self.batch.result.get()[self.uuid]
+
+class _DeferredResult(object):
+    '''Result of a download held back by the scheduler; get() is only
+    valid once _DownloadPool.wait() has started it'''
+    def __init__(self, func, args, size):
+        self.func = func
+        self.args = args
+        self.size = size
+        self.result = None
+
+    def get(self):
+        return self.result.get()
+
+class _Throughput(object):
+    '''Measures the throughput of the downloads completed so far in a run,
+    from which the time allowed for each new download is derived'''
+
+    # Rate (bytes/sec) assumed until enough data have been downloaded
+    ASSUMED_RATE = 256 * 1024
+    MIN_SAMPLE_BYTES = 4 * 1024 * 1024
+
+    # Seconds allowed for any download, however small (connection setup)
+    MIN_TIMEOUT = 60
+    # Multiple of the expected transfer time allowed, to absorb variance
+    SLACK = 4.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def record(self, nbytes, seconds):
+        with self.lock:
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    def rate(self):
+        '''Bytes per second of each download, as observed so far'''
+        with self.lock:
+            if self.bytes < self.MIN_SAMPLE_BYTES or self.seconds <= 0:
+                return self.ASSUMED_RATE
+            return self.bytes / self.seconds
+
+    def timeout(self, file_size):
+        '''Return the number of seconds to allow for downloading file_size
+        bytes (or 3 * MIN_TIMEOUT when the size is unknown)'''
+        if not file_size:
+            return 3 * self.MIN_TIMEOUT
+        expected = file_size / float(self.rate())
+        return int(self.MIN_TIMEOUT + self.SLACK * expected)
+
+class _SerialResult(object):
+    '''Result of a download performed immediately, in the calling thread'''
+    def __init__(self, func, args):
+        self.value = func(*args)
+
+    def get(self):
+        return self.value
+
+# Default size limit (bytes) of files downloaded in bulk batches
+BULK_MAX_SIZE = 1024 * 1024
+
+# Orders in which queued downloads may be started (see _DownloadPool)
+SCHEDULES = ['stream', 'smallest', 'largest']
+
+# Seconds by which incremental syncs overlap the previous sync
+SYNC_OVERLAP = 86400
+
+@contextmanager
+def _mirror_locks(prgm_roots):
+    '''Hold the mirror lock of each program root, acquired in the order
+    given (sorted, to avoid deadlock with other mirrors)'''
+    if not prgm_roots:
+        yield
+        return
+    with common.lock_context(prgm_roots[0], "mirror"):
+        with _mirror_locks(prgm_roots[1:]):
+            yield
+
+def _utc_isoformat(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+
+def _parse_utc_isoformat(text):
+    return calendar.timegm(time.strptime(text, '%Y-%m-%dT%H:%M:%S'))
+
+# Columns of the report written by gdc_mirror --verify
+VERIFY_COLUMNS = ['project', 'file_id', 'path', 'status', 'expected_md5',
+                  'actual_md5']
+
+def _verify_file(check):
+    '''Verify one mirrored file: check is a tuple of (manifest, project,
+    file dict, path).  Returns a row of the verify report, or None if the
+    file is intact.'''
+    index, project, file_d, path = check
+    uuid = file_d['file_id']
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [project, uuid, path, 'missing', file_d['md5sum'], '']
+
+    expected = meta.read_md5_file(path + ".md5")
+    actual = index.cached_md5(st)
+    if actual is None:
+        actual = common.md5_digest(path).hexdigest()
+        index.cache_md5(st, actual)
+
+    if expected is None:
+        expected = file_d['md5sum']
+        status = 'mismatch' if actual != expected else 'no_md5'
+        return [project, uuid, path, status, expected, actual]
+    if actual != expected:
+        return [project, uuid, path, 'mismatch', expected, actual]
+    return None
 
-        # Now read the file
-        datestamps_file = open(datestamps_file, 'r+')
-        stamps = datestamps_file.read().strip().split('\n')
-        if stamps[-1] != self.datestamp:
-            datestamps_file.write(self.datestamp + '\n')
+def _filter_cases(file_dict, cases):
+    '''Filter out extraneous cases from multi-case (e.g. MAF) file metadata
+    if cases have been specified'''
+    if cases and len(file_dict.get("cases", [])) > 1:
+        file_dict["cases"] = [case for case in file_dict["cases"] \
+                              if case["submitter_id"] in cases]
 
 def main():
     gdc_mirror().execute()
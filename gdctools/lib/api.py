@@ -16,12 +16,89 @@ import requests
 import json
 import logging
 import subprocess
+import io
 import os
+import time
+import random
+import hashlib
+import tarfile
+import tempfile
+import zlib
+import re
+import threading
+import collections
+import contextlib
+from email.utils import parsedate_tz, mktime_tz
+from multiprocessing.pool import ThreadPool
+from lib import common
 
 __legacy = False
 __verbosity = 0
+__cache = None
+__throttle = None
+
+# All GDC traffic (queries and downloads) shares one keep-alive session, which
+# is created lazily so that its connection pool size may be configured first
+__session = None
+__session_lock = threading.Lock()
+__pool_size = 10
+
+# Bytes read per chunk of a download (see py_download_file)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Downloads are written to <file name>.part, then renamed when complete
+PARTIAL_SUFFIX = '.part'
+
+# Exit status of curl when a server does not support resuming (byte ranges)
+CURL_RANGE_ERROR = 33
+
+class ChecksumError(IOError):
+    '''Raised when the MD5 digest of a downloaded file does not match the
+    md5sum reported by the GDC'''
+    pass
+
+# Transient failures (connection errors, HTTP 429 and 5xx) are retried up to
+# MAX_RETRIES times, with exponential backoff plus jitter between attempts,
+# unless the server says when to come back via a Retry-After header
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Seconds allowed to connect to GDC, and (by default) to wait for each read
+# of its response, so that a stalled connection fails and may be retried
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 300
 logging.getLogger("requests").setLevel(logging.WARNING)
 
+# Field profiles of file metadata queries, as (fields, expand) tuples: 'full'
+# is the historical projection, including complete case, sample & annotation
+# documents; 'slim' requests only what is used by meta.py and the dicer
+FILE_FIELD_PROFILES = {
+    'full' : (('file_id', 'file_name', 'file_size', 'cases.samples.sample_id',
+               'data_type', 'data_category', 'data_format',
+               'experimental_strategy', 'md5sum','platform','tags',
+               'center.namespace', 'cases.submitter_id',
+               'cases.project.project_id',
+               # For protein expression data
+               'cases.samples.portions.submitter_id',
+               # For aliquot-level data
+               'cases.samples.portions.analytes.aliquots.submitter_id',
+               'updated_datetime'),
+              ('cases', 'annotations', 'cases.samples')),
+    'slim' : (('file_id', 'file_name', 'file_size', 'md5sum',
+               'data_type', 'data_category', 'data_format',
+               'experimental_strategy', 'platform', 'tags',
+               'center.namespace', 'updated_datetime',
+               'cases.submitter_id', 'cases.project.project_id',
+               'cases.samples.sample_id', 'cases.samples.sample_type',
+               'cases.samples.is_ffpe',
+               'cases.samples.portions.submitter_id',
+               'cases.samples.portions.analytes.aliquots.submitter_id'),
+              ())
+}
+__file_profile = 'full'
+
 class GDCQuery(object):
     # Class variables
     ENDPOINTS = ('cases', 'files', 'programs', 'projects', 'submission')
@@ -30,6 +107,34 @@ class GDCQuery(object):
     # Queries returning more than this many results will log a warning
     WARN_RESULT_CT = 5000
 
+    # Number of threads used to fetch the pages that follow the first one;
+    # the default of 1 pages serially, as GDC has always been queried
+    PAGE_WORKERS = 1
+
+    # When page size is chosen automatically (page_size=0), the first page
+    # is fetched at AUTO_PAGE_MIN hits and used to estimate bytes & seconds
+    # per hit; later pages are then sized to stay within both targets below
+    AUTO_PAGE_MIN = 100
+    AUTO_PAGE_MAX = 10000
+    AUTO_PAGE_BYTES = 8 * 1024 * 1024
+    AUTO_PAGE_SECONDS = 10.0
+
+    # Queries whose JSON-encoded filters exceed this many characters are
+    # sent as POST requests, since very long URLs are slow or rejected
+    POST_FILTER_LENGTH = 2048
+
+    # 'in' filters with more than IN_CHUNK_SIZE values are split into chunks,
+    # queried by up to IN_CHUNK_WORKERS threads, and the hits merged
+    IN_CHUNK_SIZE = 1000
+    IN_CHUNK_WORKERS = 4
+
+    # For pagination to work, the records must specify a sort order. This
+    # lookup tells the right field to use based on the endpoint
+    SORT_FIELDS = { 'files' : 'file_id',
+                    'cases' : 'case_id',
+                    'projects' : 'project_id',
+                    'submission': 'links'}
+
     def __init__(self, endpoint, fields=None, expand=None, filters=None):
         self._endpoint = endpoint.lower()               # normalize to lowercase
         assert(endpoint in GDCQuery.ENDPOINTS)
@@ -45,6 +150,10 @@ class GDCQuery(object):
     def add_in_filter(self, field, values):
         self._filters.append(_in_filter(field,values))
 
+    def add_filter(self, filt):
+        self._filters.append(filt)
+        return self
+
     def filters(self):
         return self._filters
 
@@ -75,31 +184,117 @@ class GDCQuery(object):
         if self._expand:
             params['expand'] = ','.join(self._expand)
         if self._filters:
-            if len(self._filters) == 1:
-                params['filters'] = json.dumps(self._filters[0])
-            else:
-                params['filters'] = json.dumps(_and_filter(self._filters))
+            params['filters'] = json.dumps(self._filter())
         return params
 
-    def _query_paginator(self, page_size=500, from_idx=1, to_idx=-1):
-        '''Returns list of hits, iterating over server paging'''
+    def _filter(self):
+        '''The single filter object equivalent to all filters of this query'''
+        if len(self._filters) == 1:
+            return self._filters[0]
+        return _and_filter(self._filters)
+
+    def _send(self, endpoint, params, **kwargs):
+        '''Issue the query with the given paging params (and any other
+        arguments of the request, e.g. stream).  Queries whose filters are
+        too long to be sensibly encoded into a URL are POSTed, with the
+        filters (and other params) sent in a JSON body instead'''
+        if len(params.get('filters', '')) <= GDCQuery.POST_FILTER_LENGTH:
+            return _get(endpoint, params=params, **kwargs)
+        body = dict(params)
+        body['filters'] = self._filter()
+        return _post(endpoint, json=body, **kwargs)
+
+    def _chunked_queries(self):
+        '''If this query has an 'in' filter with more than IN_CHUNK_SIZE
+        values, return a list of queries which each filter on one chunk of
+        those values (the longest such filter is chunked); otherwise return
+        None'''
+        longest = None
+        for idx, filt in enumerate(self._filters):
+            if filt.get('op') != 'in':
+                continue
+            values = filt['content']['value']
+            if len(values) > GDCQuery.IN_CHUNK_SIZE and (longest is None or
+                    len(values) > len(self._filters[longest]['content']['value'])):
+                longest = idx
+        if longest is None:
+            return None
+
+        field = self._filters[longest]['content']['field']
+        values = self._filters[longest]['content']['value']
+        queries = []
+        for start in range(0, len(values), GDCQuery.IN_CHUNK_SIZE):
+            filters = list(self._filters)
+            filters[longest] = _in_filter(field,
+                                  values[start:start+GDCQuery.IN_CHUNK_SIZE])
+            queries.append(GDCQuery(self._endpoint, fields=list(self._fields),
+                                    expand=list(self._expand), filters=filters))
+        return queries
+
+    def iter_pages(self, page_size=500, from_idx=1, to_idx=-1, workers=None):
+        '''Generator yielding the list of hits on each server page, in order.
+
+        Hits are numbered from 1, and from_idx/to_idx bound (inclusively) the
+        range returned; a to_idx of -1 means all hits.  If page_size is 0 (or
+        None) it is chosen automatically from the size and latency of the
+        first page.  If workers is greater than 1, up to that many pages are
+        prefetched concurrently while the caller consumes earlier ones, so at
+        most that many pages are held in memory at once.
+
+        If a response cache has been set (see set_cache) and this endpoint is
+        cacheable, all hits are instead returned as one page, either from the
+        cache or by paging through the server and then caching the result;
+        so by default only endpoints with small answers are cached (see
+        ResponseCache.DEFAULT_TTLS).'''
+        cache = get_cache()
+        if cache is None or not cache.cacheable(self._endpoint):
+            for hits in self._iter_server_pages(page_size, from_idx, to_idx,
+                                                workers):
+                yield hits
+            return
+
+        request = { 'url' : self._base_url(),
+                    'params' : self._params(),
+                    'legacy' : get_legacy(),
+                    'from' : from_idx,
+                    'to' : to_idx }
+        hits = cache.lookup(self._endpoint, request)
+        if hits is None:
+            hits = []
+            for page in self._iter_server_pages(page_size, from_idx, to_idx,
+                                                workers):
+                hits.extend(page)
+            cache.store(self._endpoint, request, hits)
+        yield hits
+
+    def _iter_server_pages(self, page_size, from_idx, to_idx, workers):
+        '''Generator yielding pages of hits from GDC; see iter_pages()'''
         endpoint = self._base_url()
         p = self._params()
+        auto_size = not page_size
+        if auto_size:
+            page_size = GDCQuery.AUTO_PAGE_MIN
+        if workers is None:
+            workers = GDCQuery.PAGE_WORKERS
+        if to_idx != -1:
+            page_size = max(1, min(page_size, to_idx - from_idx + 1))
         p['from'] = from_idx
         p['size'] = page_size
 
-        # For pagination to work, the records must specify a sort order. This
-        # lookup tells the right field to use based on the endpoint
-        sort_lookup = { 'files' : 'file_id',
-                        'cases' : 'case_id',
-                        'projects' : 'project_id',
-                        'submission': 'links'}
-
         endpoint_name = endpoint.rstrip('/').split('/')[-1]
-        p['sort'] = sort_lookup.get(endpoint_name, "")
+        p['sort'] = GDCQuery.SORT_FIELDS.get(endpoint_name, "")
+
+        # Very long 'in' filters are split into several smaller queries
+        chunks = self._chunked_queries()
+        if chunks:
+            hits = _merge_hits(self._query_chunks(chunks), p['sort'])
+            if to_idx != -1:
+                hits = hits[:to_idx]
+            yield hits[from_idx-1:]
+            return
 
         # Make initial call
-        r = requests.get(endpoint, params=p)
+        r = self._send(endpoint, p)
         if get_verbosity():
             print("\nGDC query: %s\n" % r.url)
         r_json = _decode_json(r)
@@ -111,40 +306,94 @@ class GDCQuery(object):
         # within a {"data": {"hits": … } }  JSON block--so we work around here.
         if endpoint_name == 'submission':
             results = r_json['links']
-            results = [ program.split('/')[-1] for program in results ]
-            self.hits = results
-            return results
+            yield [ program.split('/')[-1] for program in results ]
+            return
 
         # The 'programs' endpoint does not actually exist in GDC api (but has
         # been requested by Broad). Until then we fake it for convenience.
         if endpoint_name == 'programs':
-            self.hits = get_programs()
-            return self.hits
+            yield get_programs()
+            return
 
         # Get first page of hits, and pagination data
         data = r_json['data']
-        all_hits = data['hits']
-        pagination = data['pagination']
-        total = pagination['total'] if to_idx == -1 else to_idx
+        hits = data['hits']
+        self.total = data['pagination']['total']
+        last_idx = self.total if to_idx == -1 else min(self.total, to_idx)
 
         # Some queries can return a large number of results, warn here
-        if total > GDCQuery.WARN_RESULT_CT:
-            logging.warning(str(total) + " files match this query, paging "
+        if last_idx - from_idx + 1 > GDCQuery.WARN_RESULT_CT:
+            logging.warning(str(self.total) + " files match this query, paging "
                             + "through all results may take some time")
 
-        for from_idx in range(page_size+1, total, page_size):
-            #Iterate over pages to get the remaning hits
-            p['from'] = from_idx
-            r = requests.get(endpoint, params=p)
+        # Remaining pages start right after the first one
+        first_idx = from_idx + page_size
+        if auto_size and hits:
+            page_size = _auto_page_size(r, len(hits))
+            logging.debug("Automatic GDC page size: %d" % page_size)
+        del r, r_json, data
 
-            hits = _decode_json(r)['data']['hits']
-            all_hits.extend(hits)
+        yield hits
+        del hits
+
+        # Chop off hits on the last page if they exceed to_idx
+        def fetch(idx):
+            return self._fetch_page(endpoint, p, idx, page_size)[:last_idx-idx+1]
+
+        offsets = range(first_idx, last_idx + 1, page_size)
+        if workers > 1 and len(offsets) > 1:
+            pages = _ordered_imap(fetch, offsets, workers)
+        else:
+            pages = (fetch(idx) for idx in offsets)
+        for hits in pages:
+            yield hits
+
+    def iter_hits(self, page_size=500, from_idx=1, to_idx=-1, workers=None):
+        '''Generator yielding hits one at a time; see iter_pages()'''
+        for hits in self.iter_pages(page_size, from_idx, to_idx, workers):
+            for hit in hits:
+                yield hit
 
+    def _query_paginator(self, page_size=500, from_idx=1, to_idx=-1,
+                         workers=None):
+        '''Returns list of hits, iterating over server paging'''
+        all_hits = []
+        for hits in self.iter_pages(page_size, from_idx, to_idx, workers):
+            all_hits.extend(hits)
         self.hits = all_hits
-        return all_hits # Chop off hits on the last page if they exceed to_idx
+        return all_hits
+
+    def _fetch_page(self, endpoint, params, from_idx, page_size):
+        '''Returns the hits of the single page starting at from_idx'''
+        p = dict(params)
+        p['from'] = from_idx
+        p['size'] = page_size
+        r = self._send(endpoint, p)
+        return _decode_json(r)['data']['hits']
+
+    def _query_chunks(self, queries):
+        '''Return the list of hit lists of each (chunked) query, fetching
+        up to IN_CHUNK_WORKERS of them concurrently'''
+        def fetch(query):
+            hits = []
+            for page in query._iter_server_pages(500, 1, -1, 1):
+                hits.extend(page)
+            return hits
+
+        logging.info("Splitting GDC query into %d chunks" % len(queries))
+        workers = min(GDCQuery.IN_CHUNK_WORKERS, len(queries))
+        if workers <= 1:
+            return [fetch(q) for q in queries]
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(fetch, queries)
+        finally:
+            pool.close()
+            pool.join()
 
-    def get(self, page_size=500):
-        return self._query_paginator(page_size=page_size)
+    def get(self, page_size=500, workers=None, to_idx=-1):
+        return self._query_paginator(page_size=page_size, to_idx=to_idx,
+                                     workers=workers)
 
 def get_projects(program=None):
     query = GDCQuery('projects')
@@ -178,36 +427,123 @@ def get_data_categories(project):
         return [] # Needed to protect against projects with no data
 
 def get_project_files(project_id, data_category, workflow_type=None, cases=None,
-                      page_size=500):
+                      page_size=500, updated_since=None):
+    '''Return file dicts of one data category (or a list of categories).  If
+    updated_since is given (as an ISO 8601 date/time) then only files updated
+    after that time are returned'''
+    query = _project_files_query(project_id, data_category, workflow_type,
+                                 cases, updated_since)
+    return query.get(page_size=page_size)
+
+def iter_project_files(project_id, data_category, workflow_type=None,
+                       cases=None, page_size=500, updated_since=None):
+    '''Like get_project_files(), but yields file dicts as pages arrive'''
+    query = _project_files_query(project_id, data_category, workflow_type,
+                                 cases, updated_since)
+    return query.iter_hits(page_size=page_size)
+
+def get_project_file_ids(project_id, data_category, workflow_type=None,
+                         cases=None):
+    '''Return only the uuids of the files get_project_files() would return,
+    which is far cheaper than retrieving their complete metadata'''
+    query = _project_files_query(project_id, data_category, workflow_type,
+                                 cases, ids_only=True)
+    return [fd['file_id'] for fd in query.iter_hits(page_size=0)]
+
+def _project_files_query(project_id, data_category, workflow_type, cases,
+                         updated_since=None, ids_only=False, profile=None):
     query = GDCQuery('files')
     query.add_eq_filter("cases.project.project_id", project_id)
-    query.add_eq_filter("files.data_category", data_category)
+    query.add_filter(_data_category_filter(data_category))
     query.add_eq_filter("access", "open")
 
-    if not __legacy:
-        if workflow_type:
-            query.add_eq_filter('analysis.workflow_type', workflow_type)
-        query.add_fields('analysis.workflow_type')
+    if not __legacy and workflow_type:
+        query.add_eq_filter('analysis.workflow_type', workflow_type)
 
     if cases:
         query.add_in_filter('cases.submitter_id', cases)
 
-    query.add_fields('file_id', 'file_name', 'cases.samples.sample_id',
-                     'data_type', 'data_category', 'data_format',
-                     'experimental_strategy', 'md5sum','platform','tags',
-                     'center.namespace', 'cases.submitter_id',
-                     'cases.project.project_id',
-                     # For protein expression data
-                     'cases.samples.portions.submitter_id',
-                     # For aliquot-level data
-                     'cases.samples.portions.analytes.aliquots.submitter_id')
+    if updated_since:
+        query.add_filter(_gt_filter('updated_datetime', updated_since))
 
-    # Avoid pathology reports & images (can be huge), only retrieve XML for now
-    if data_category == "Clinical":
-        query.add_eq_filter("data_format", "BCR XML")
+    if ids_only:
+        query.add_fields('file_id')
+        return query
 
-    query.expand('cases', 'annotations', 'cases.samples')
-    return query.get(page_size=page_size)
+    profile = profile if profile else get_file_profile()
+    fields, expand = FILE_FIELD_PROFILES[profile]
+    if not __legacy:
+        query.add_fields('analysis.workflow_type')
+    query.add_fields(*fields)
+    if expand:
+        query.expand(*expand)
+    return query
+
+def measure_file_profiles(project_id, data_category, num_hits=500):
+    '''Fetch the first num_hits file dicts of a project & data category with
+    each field profile, and return a dict mapping each profile name to a
+    (decoded bytes per hit, transferred bytes per hit) tuple; the latter
+    reflects any compression of the response'''
+    sizes = dict()
+    for profile in sorted(FILE_FIELD_PROFILES):
+        query = _project_files_query(project_id, data_category, None, None,
+                                     profile=profile)
+        params = query._params()
+        params['from'] = 1
+        params['size'] = num_hits
+        params['sort'] = GDCQuery.SORT_FIELDS['files']
+        # Content-Length is absent from chunked responses, and the length of
+        # the content is its decompressed size, so the encoded body is read
+        # (and counted) as it streams in, then decoded here
+        r = query._send(query._base_url(), params, stream=True,
+                        headers={'Accept-Encoding' : 'gzip, deflate'})
+        try:
+            encoded = b''.join(r.raw.stream(64 * 1024, decode_content=False))
+        finally:
+            r.close()
+        content = _decode_content(encoded, r.headers.get('Content-Encoding'))
+        hits = len(json.loads(content.decode('utf-8'))['data']['hits'])
+        if hits == 0:
+            continue
+        sizes[profile] = (len(content) / float(hits),
+                          len(encoded) / float(hits))
+    return sizes
+
+def _decode_content(data, encoding):
+    '''Decode a response body sent with the given Content-Encoding'''
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate data, without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    if encoding == 'identity':
+        return data
+    raise ValueError("Unsupported Content-Encoding: " + encoding)
+
+def _data_category_filter(data_category):
+    '''Filter selecting files of one data category, or of any of a list of
+    them, so that several categories may be retrieved with a single query'''
+    if isinstance(data_category, (list, tuple)):
+        categories = list(data_category)
+    else:
+        categories = [data_category]
+
+    # Avoid pathology reports & images (can be huge), only retrieve XML for now
+    filters = []
+    others = [c for c in categories if c != "Clinical"]
+    if others:
+        if len(others) == 1:
+            filters.append(_eq_filter("files.data_category", others[0]))
+        else:
+            filters.append(_in_filter("files.data_category", others))
+    if "Clinical" in categories:
+        filters.append(_and_filter([_eq_filter("files.data_category", "Clinical"),
+                                    _eq_filter("data_format", "BCR XML")]))
+    return filters[0] if len(filters) == 1 else _or_filter(filters)
 
 def curl_exists():
     """ Return true if curl can be executed on this system """
@@ -219,29 +555,222 @@ def curl_exists():
     except (OSError, subprocess.CalledProcessError):
         return False
 
-def py_download_file(uuid, file_name, chunk_size=4096):
-    """Download a single file from GDC."""
-    url = GDCQuery.GDC_ROOT
-    if __legacy: url += 'legacy/'
-    url += 'data/' + uuid
-    r = requests.get(url, stream=True)
-    # TODO: Optimize chunk size
-    # Larger chunk size == more memory, but fewer packets
-    with open(file_name, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            if chunk:
-                f.write(chunk)
-
-    # Return the response, which includes status_code, http headers, etc.
-    return r
-
-def curl_download_file(uuid, file_name, max_time=180):
-    """Download a single file from the GDC, using cURL"""
-    url = GDCQuery.GDC_ROOT
-    if __legacy: url += 'legacy/'
-    url += 'data/' + uuid
-    curl_args = ['curl', '--max-time', str(max_time), '--fail', '-o', file_name, url]
-    return subprocess.check_call(curl_args)
+def curl_supports_parallel():
+    """ Return true if the installed curl can run many transfers in
+    parallel (i.e. supports --parallel, added in curl 7.66) """
+    try:
+        version = subprocess.check_output(['curl', '-V'],
+                                          stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    match = re.match(r'curl (\d+)\.(\d+)', version.decode('ascii', 'replace'))
+    if not match:
+        return False
+    return (int(match.group(1)), int(match.group(2))) >= (7, 66)
+
+def py_download_file(uuid, file_name, chunk_size=None, file_size=None,
+                     md5sum=None, max_time=None):
+    """Download a single file from GDC.
+
+    Data are written to <file_name>.part, resuming from the end of any such
+    partial file left by an earlier attempt, and renamed to file_name only
+    once complete (see _finalize_download).  The MD5 digest is computed as
+    the data arrive, and if md5sum is given the file must match it.  Like
+    the cURL option of the same name, max_time bounds the duration of the
+    whole transfer.  Data are read chunk_size bytes at a time (by default
+    DOWNLOAD_CHUNK_SIZE) into a single reusable buffer, and under Python 3
+    the file is preallocated when its size is known.  Returns the (md5
+    hexdigest, size) of the downloaded file."""
+    url = _data_url(uuid)
+    part_name = file_name + PARTIAL_SUFFIX
+    offset = _partial_size(part_name, file_size)
+
+    # Ask for the raw bytes, so that byte ranges correspond to file offsets
+    headers = {'Accept-Encoding' : 'identity'}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    with _connection():
+        started = time.time()
+        r = _get(url, stream=True, headers=headers,
+                 timeout=_timeouts(max_time))
+        r.raise_for_status()
+
+        # Servers ignoring the Range header send the whole file (status 200)
+        if r.status_code != 206:
+            offset = 0
+        # Larger chunks mean fewer Python-level iterations per file, at the
+        # cost of memory
+        chunks = _read_chunks(_body_stream(r),
+                              chunk_size or DOWNLOAD_CHUNK_SIZE)
+        if max_time:
+            chunks = _time_limited(chunks, started + max_time, file_name)
+        try:
+            digest = _write_download(part_name, _throttled(chunks), offset,
+                                     file_size)
+            # The body was read in full, so its connection may be reused;
+            # otherwise closing the response closes the connection
+            r.raw.release_conn()
+        finally:
+            r.close()
+
+    return _finalize_download(part_name, file_name, digest, file_size, md5sum,
+                              resumed=bool(offset))
+
+def curl_download_file(uuid, file_name, max_time=180, file_size=None,
+                       md5sum=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Download a single file from the GDC, using cURL.  As with
+    py_download_file, interrupted downloads are resumed from a .part file,
+    and the data are hashed as they are read from the cURL output stream.
+    Returns the (md5 hexdigest, size) of the downloaded file."""
+    url = _data_url(uuid)
+    part_name = file_name + PARTIAL_SUFFIX
+    offset = _partial_size(part_name, file_size)
+    curl_args = ['curl', '--max-time', str(max_time), '--fail', '--silent',
+                 '--show-error']
+    if offset:
+        curl_args += ['--continue-at', str(offset)]
+    curl_args.append(url)
+
+    # cURL is held to the rate limit by the pace at which its output is read
+    with _connection():
+        proc = subprocess.Popen(curl_args, stdout=subprocess.PIPE)
+        chunks = _throttled(_read_chunks(proc.stdout, chunk_size))
+        try:
+            digest = _write_download(part_name, chunks, offset, file_size)
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+
+    if returncode != 0:
+        # Server refused to resume, so start over on the next attempt
+        if returncode == CURL_RANGE_ERROR:
+            common.silent_rm(part_name)
+        raise subprocess.CalledProcessError(returncode, curl_args)
+
+    return _finalize_download(part_name, file_name, digest, file_size, md5sum,
+                              resumed=bool(offset))
+
+def curl_download_files(file_dicts, save_paths, max_time=180, parallel=4):
+    """Download many files from the GDC with a single cURL process, which
+    reuses its connections and runs up to parallel transfers at a time.
+    The URL and output (.part) file of each transfer are listed in a
+    temporary cURL config file.  When cURL exits each file is verified
+    against the md5sum and file_size of its metadata, then renamed to the
+    path given for its uuid in the save_paths dict; max_time bounds each
+    transfer, as in curl_download_file.
+
+    Returns a pair of dicts: the first maps the uuid of each file
+    successfully downloaded to its (md5 hexdigest, size), and the second
+    maps the uuid of each failed file to the reason it failed.
+
+    The transfers count against the connection limit of the throttle (see
+    set_throttle), but not its rate limit: cURL writes the files itself,
+    and its own --limit-rate is not reliably enforced with --parallel."""
+    files = dict((fd['file_id'], fd) for fd in file_dicts)
+    with _connection(min(parallel, len(files))) as parallel:
+        lines = ['parallel', 'parallel-max = %d' % parallel, 'fail',
+                 'silent', 'show-error',
+                 'continue-at = "-"', 'max-time = %d' % max_time,
+                 'write-out = "%{url_effective}\\t%{http_code}\\n"']
+        for uuid in sorted(files):
+            file_dict = files[uuid]
+            part_name = save_paths[uuid] + PARTIAL_SUFFIX
+            _partial_size(part_name, file_dict.get('file_size'))
+            lines.append('url = ' + _curl_quote(_data_url(uuid)))
+            lines.append('output = ' + _curl_quote(part_name))
+
+        fd, config_file = tempfile.mkstemp(suffix='.curlrc')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            proc = subprocess.Popen(['curl', '--config', config_file],
+                                    stdout=subprocess.PIPE)
+            output = proc.communicate()[0].decode('utf-8', 'replace')
+        finally:
+            common.silent_rm(config_file)
+
+    # One line of output per transfer attempted: its URL and HTTP status
+    status = dict()
+    for line in output.splitlines():
+        url, _, code = line.rpartition('\t')
+        status[url.rsplit('/', 1)[-1]] = code
+
+    verified, failed = dict(), dict()
+    for uuid in sorted(files):
+        file_dict = files[uuid]
+        file_name = save_paths[uuid]
+        part_name = file_name + PARTIAL_SUFFIX
+        code = status.get(uuid)
+        if code not in ('200', '206') or not os.path.isfile(part_name):
+            failed[uuid] = "HTTP status " + str(code)
+            continue
+        try:
+            verified[uuid] = _finalize_download(part_name, file_name,
+                                            _file_md5(part_name),
+                                            file_dict.get('file_size'),
+                                            file_dict.get('md5sum'))
+        except IOError as e:
+            failed[uuid] = str(e)
+    return verified, failed
+
+def bulk_download_files(file_dicts, save_paths, chunk_size=65536,
+                        max_time=None):
+    """Download many files from the GDC with one request, by POSTing their
+    uuids to the data endpoint, which responds with a tar.gz archive in
+    which each file is named <uuid>/<file_name>.  The archive is extracted
+    as it streams in: each member is written to the path given for its uuid
+    in the save_paths dict, via a .part file, and verified against the
+    md5sum and file_size of its metadata.
+
+    Returns a dict mapping the uuid of each file successfully downloaded to
+    its (md5 hexdigest, size).  Files missing from the archive, or failing
+    verification, are logged and left out, so that the caller may fetch
+    them individually.  No read of the archive may wait longer than
+    max_time (by default READ_TIMEOUT) seconds."""
+    files = dict((fd['file_id'], fd) for fd in file_dicts)
+    # With a single id the GDC returns the file itself, not an archive
+    if len(files) < 2:
+        raise ValueError("Bulk downloads require at least 2 files")
+
+    with _connection():
+        verified = _bulk_extract(files, save_paths, chunk_size, max_time)
+
+    missing = len(files) - len(verified)
+    if missing:
+        logging.warning("%d of %d files not verified in bulk download" % \
+                        (missing, len(files)))
+    return verified
+
+def _bulk_extract(files, save_paths, chunk_size, max_time=None):
+    '''Request the files (a dict indexed by uuid) from the bulk data
+    endpoint, then extract and verify them; see bulk_download_files'''
+    headers = {'Accept-Encoding' : 'identity'}
+    r = _post(_data_url(), json={'ids' : sorted(files)}, headers=headers,
+              stream=True, timeout=_timeouts(max_time))
+    r.raise_for_status()
+
+    verified = dict()
+    with tarfile.open(fileobj=r.raw, mode='r|gz') as archive:
+        for member in archive:
+            uuid = member.name.split('/')[0]
+            if not member.isfile() or uuid not in files:
+                continue    # e.g. MANIFEST.txt
+
+            file_dict = files[uuid]
+            file_name = save_paths[uuid]
+            part_name = file_name + PARTIAL_SUFFIX
+            data = archive.extractfile(member)
+            chunks = _throttled(iter(lambda: data.read(chunk_size), b''))
+            digest = _write_download(part_name, chunks,
+                                     file_size=member.size)
+            try:
+                verified[uuid] = _finalize_download(part_name, file_name,
+                                            digest, file_dict.get('file_size'),
+                                            file_dict.get('md5sum'))
+            except IOError as e:
+                logging.warning(str(e))
+                common.silent_rm(part_name)
+    return verified
 
 def get_program(project):
     '''Return the program name of a project.'''
@@ -258,6 +787,33 @@ def get_program(project):
 
     return projects[0]['program']['name']
 
+def get_projects_info(projects):
+    '''Resolve program name, data categories and file counts for many
+    projects with a single query, instead of one query per project.  Returns
+    a dict indexed by project_id, whose values are dicts of the form
+
+        { 'program' : 'TCGA',
+          'file_count' : 1234,
+          'data_categories' : { 'Clinical' : 92, 'Biospecimen' : 184, ...} }
+
+    Projects unknown to the GDC are absent from the returned dict.'''
+    query = GDCQuery('projects')
+    query.add_in_filter('project_id', sorted(set(projects)))
+    query.add_fields('project_id', 'program.name', 'summary.file_count',
+                     'summary.data_categories.data_category',
+                     'summary.data_categories.file_count')
+
+    info = dict()
+    for proj in query.get():
+        summary = proj.get('summary', {})     # Projects may have no data
+        categories = dict()
+        for d in summary.get('data_categories', []):
+            categories[d['data_category']] = d.get('file_count', 0)
+        info[proj['project_id']] = { 'program' : proj['program']['name'],
+                                     'file_count' : summary.get('file_count', 0),
+                                     'data_categories' : categories }
+    return info
+
 def get_programs(projects=None):
     '''Return list of programs that have data EXPOSED in GDC.  Note that this
        may be different from the set of programs that have SUBMITTED data to
@@ -275,6 +831,263 @@ def get_programs(projects=None):
     return list(set(programs))
 
 # Module helpers
+def _data_url(uuid=None):
+    url = GDCQuery.GDC_ROOT
+    if __legacy: url += 'legacy/'
+    url += 'data'
+    if uuid: url += '/' + uuid
+    return url
+
+def _partial_size(part_name, file_size=None):
+    '''Return the number of bytes already downloaded to part_name, from
+    which a download may resume.  A partial file no smaller than the
+    expected file size cannot be resumed, and is removed.'''
+    try:
+        size = os.path.getsize(part_name)
+    except OSError:
+        return 0
+    if file_size is not None and size >= file_size:
+        common.silent_rm(part_name)
+        return 0
+    return size
+
+def _file_md5(file_name):
+    '''Return an MD5 hash object updated with the contents of file_name'''
+    return common.md5_digest(file_name)
+
+def _curl_quote(value):
+    '''Quote a value for a cURL config file'''
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _body_stream(r):
+    '''Return a file-like object from which the body of the streamed
+    response r may be read, decoded: its urllib3 response, which keeps
+    track of the connection, so that it may be returned to the pool of the
+    session once the body has been read'''
+    raw = r.raw
+    raw.decode_content = True
+    return raw
+
+@contextlib.contextmanager
+def _connection(n=1):
+    '''Reserve up to n download connections from the throttle, if any (see
+    set_throttle), yielding the number reserved'''
+    throttle = get_throttle()
+    if throttle is None:
+        yield n
+    else:
+        with throttle.connection(n) as reserved:
+            yield reserved
+
+def _throttled(chunks):
+    '''Pass chunks through, at no more than the rate limit of the throttle'''
+    throttle = get_throttle()
+    if throttle is None:
+        return chunks
+    return _consuming(chunks, throttle)
+
+def _consuming(chunks, throttle):
+    for chunk in chunks:
+        throttle.consume(len(chunk))
+        yield chunk
+
+def _read_chunks(stream, chunk_size):
+    '''Yield the data read from stream as memoryview slices of one buffer
+    of chunk_size bytes, which is reused: each chunk is only valid until
+    the next is requested'''
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        n = stream.readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+
+def _write_download(part_name, chunks, offset=0, file_size=None):
+    '''Write chunks of downloaded data to part_name, appending to the
+    first offset bytes already there (if any), and return an MD5 hash object
+    updated with all of the data written.  Only a resumed download needs
+    to re-read the bytes of its earlier attempt.  If file_size is given the
+    file is first preallocated (where the OS supports it), and in any case
+    is truncated to the data actually written, so that its size remains
+    the offset from which an interrupted download may resume.'''
+    digest = _file_md5(part_name) if offset else hashlib.md5()
+    # Not opened for appending: writes must land at the offset, not at the
+    # end of the space preallocated beyond it
+    with io.open(part_name, 'r+b' if offset else 'wb', buffering=0) as f:
+        f.seek(offset)
+        if file_size and file_size > offset:
+            _preallocate(f, offset, file_size - offset)
+        written = offset
+        try:
+            for chunk in chunks:
+                if chunk:
+                    digest.update(chunk)
+                    _write_all(f, chunk)
+                    written += len(chunk)
+        finally:
+            f.truncate(written)
+    return digest
+
+def _write_all(f, data):
+    '''Write all of data to the unbuffered file f, which may accept only
+    part of it per write'''
+    view = memoryview(data)
+    while view:
+        n = f.write(view)
+        view = view[n:]
+
+def _preallocate(f, offset, length):
+    '''Reserve disk space for length bytes of f at offset, to limit
+    fragmentation of large files; not every OS or filesystem supports it.
+    Python 2 has no os.posix_fallocate, so there this does nothing.'''
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), offset, length)
+    except OSError:
+        pass
+
+def _timeouts(max_time=None):
+    '''Return the (connect, read) timeouts of a download allowed max_time
+    seconds in all: no single read may wait longer than the whole transfer'''
+    read = READ_TIMEOUT if not max_time else min(READ_TIMEOUT, max_time)
+    return (CONNECT_TIMEOUT, read)
+
+def _time_limited(chunks, deadline, file_name):
+    '''Pass chunks through until the deadline, then raise IOError; the
+    data received so far are kept, so that the next attempt may resume'''
+    for chunk in chunks:
+        yield chunk
+        if time.time() > deadline:
+            raise IOError("Timed out downloading " + file_name)
+
+def _finalize_download(part_name, file_name, digest, file_size=None,
+                       md5sum=None, resumed=False):
+    '''Verify a completed partial download, then atomically rename it into
+    place and return its (md5 hexdigest, size).  If the expected file_size
+    is known and not yet reached, the partial file is kept, so that the next
+    attempt may resume it, and IOError is raised.  A file that does not
+    match the expected md5sum is removed, and ChecksumError is raised.
+    The digest covers the data as received, so a resumed download is also
+    hashed as written to disk, which must match it.'''
+    size = os.path.getsize(part_name)
+    if file_size is not None and size != file_size:
+        if size > file_size:
+            common.silent_rm(part_name)
+        raise IOError("Incomplete download of %s: %d of %d bytes" % \
+                      (file_name, size, file_size))
+
+    md5 = digest.hexdigest()
+    if md5sum is not None and md5 != md5sum:
+        common.silent_rm(part_name)
+        raise ChecksumError("MD5 mismatch for %s: expected %s, got %s" % \
+                            (file_name, md5sum, md5))
+    if resumed:
+        on_disk = _file_md5(part_name).hexdigest()
+        if on_disk != md5:
+            common.silent_rm(part_name)
+            raise ChecksumError("Resumed download of %s corrupt on disk: "
+                                "expected MD5 %s, got %s" % (file_name, md5,
+                                                             on_disk))
+
+    os.rename(part_name, file_name)
+    return md5, size
+
+def _get(url, **kwargs):
+    '''Issue a GET through the shared session; see _request()'''
+    return _request('GET', url, **kwargs)
+
+def _post(url, **kwargs):
+    '''Issue a POST through the shared session; see _request()'''
+    return _request('POST', url, **kwargs)
+
+def _request(method, url, **kwargs):
+    '''Issue a request through the shared session, retrying transient failures.
+
+    The response to the final attempt is returned even if its status is
+    still an error, so callers see the same response they always have;
+    connection errors and timeouts are re-raised once retries are exhausted.
+    Unless the caller gives its own, the (CONNECT_TIMEOUT, READ_TIMEOUT)
+    timeouts apply.'''
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    session = get_session()
+    attempt = 0
+    while True:
+        try:
+            r = session.request(method, url, **kwargs)
+            if r.status_code not in RETRY_STATUS_CODES or \
+                                                    attempt >= MAX_RETRIES:
+                return r
+            delay = _retry_after(r)
+            reason = "HTTP %d" % r.status_code
+            r.close()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = None
+            reason = str(e)
+
+        if delay is None:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+            delay = random.uniform(0, delay)        # "full jitter"
+        attempt += 1
+        logging.warning("GDC request failed (%s), retry %d of %d in %.1f "
+                        "seconds: %s" % (reason, attempt, MAX_RETRIES, delay,
+                                         url))
+        time.sleep(delay)
+
+def _merge_hits(hit_lists, sort_field):
+    '''Merge several lists of hits into one, sorted by sort_field and without
+    duplicates.  Hits lacking sort_field are identified by their GDC id'''
+    merged = dict()
+    unkeyed = []
+    for hits in hit_lists:
+        for hit in hits:
+            key = hit.get(sort_field, hit.get('id'))
+            if key is None:
+                unkeyed.append(hit)
+            else:
+                merged[key] = hit
+    return [merged[key] for key in sorted(merged)] + unkeyed
+
+def _ordered_imap(func, items, workers):
+    '''Generator yielding func(item) for each item, in order, while up to
+    workers calls run ahead concurrently in a thread pool'''
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    items = iter(items)
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= workers:
+                break
+        while pending:
+            result = pending.popleft().get()
+            for item in items:
+                pending.append(pool.apply_async(func, (item,)))
+                break
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def _retry_after(response):
+    '''Return the delay in seconds requested by a Retry-After header, or None.
+    Both the delta-seconds and HTTP-date forms of the header are honored.'''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        delay = mktime_tz(date) - time.time()
+    return min(BACKOFF_MAX, max(0.0, delay))
+
 def _log_warnings(r_json, r_url):
     '''Check for warnings in a server response'''
     warnings = r_json.get('warnings', None)
@@ -287,12 +1100,30 @@ def _log_warnings(r_json, r_url):
 def _eq_filter(field, value):
     return {"op" : "=", "content" : {"field" : field, "value" : [value]}}
 
+def _gt_filter(field, value):
+    return {"op" : ">", "content" : {"field" : field, "value" : value}}
+
 def _and_filter(filters):
     return {"op" : "and", "content" : filters}
 
+def _or_filter(filters):
+    return {"op" : "or", "content" : filters}
+
 def _in_filter(field, values):
     return {"op" : "in", "content" : {"field": field, "value": values} }
 
+def _auto_page_size(response, num_hits):
+    '''Choose a page size from the byte size & latency of a response holding
+    num_hits hits, such that later pages stay within GDCQuery.AUTO_PAGE_BYTES
+    and GDCQuery.AUTO_PAGE_SECONDS'''
+    bytes_per_hit = max(len(response.content) / float(num_hits), 1.0)
+    secs_per_hit = response.elapsed.total_seconds() / float(num_hits)
+    size = GDCQuery.AUTO_PAGE_BYTES / bytes_per_hit
+    if secs_per_hit > 0:
+        size = min(size, GDCQuery.AUTO_PAGE_SECONDS / secs_per_hit)
+    size = max(GDCQuery.AUTO_PAGE_MIN, min(GDCQuery.AUTO_PAGE_MAX, int(size)))
+    return size
+
 def _decode_json(request):
     """ Attempt to decode response from request using the .json() method.
 
@@ -331,3 +1162,69 @@ def set_verbosity(verbosity):
 
 def get_verbosity():
     return __verbosity
+
+def set_cache(cache):
+    '''Set the ResponseCache (see lib/cache.py) consulted by GDCQuery, or
+    None to always query the GDC'''
+    global __cache
+    previous_value = __cache
+    __cache = cache
+    return previous_value
+
+def get_cache():
+    return __cache
+
+def set_throttle(throttle):
+    '''Set the Throttle (see lib/throttle.py) which limits the bandwidth and
+    number of connections used by downloads, or None for no limits'''
+    global __throttle
+    previous_value = __throttle
+    __throttle = throttle
+    return previous_value
+
+def get_throttle():
+    return __throttle
+
+def set_file_profile(profile):
+    '''Select the FILE_FIELD_PROFILES entry used by file metadata queries'''
+    global __file_profile
+    if profile not in FILE_FIELD_PROFILES:
+        raise ValueError("Unknown file metadata profile '%s', expected one "
+                         "of: %s" % (profile, ", ".join(sorted(FILE_FIELD_PROFILES))))
+    previous_value = __file_profile
+    __file_profile = profile
+    return previous_value
+
+def get_file_profile():
+    return __file_profile
+
+def get_session():
+    '''Return the requests.Session shared by all GDC queries & downloads'''
+    global __session
+    with __session_lock:
+        if __session is None:
+            session = requests.Session()
+            # Metadata responses are verbose JSON, which compresses very well
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            adapter = requests.adapters.HTTPAdapter(pool_connections=__pool_size,
+                                                    pool_maxsize=__pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            __session = session
+        return __session
+
+def set_pool_size(pool_size):
+    '''Set the number of keep-alive connections kept open to GDC; this should
+    be at least the number of threads issuing requests concurrently'''
+    global __pool_size, __session
+    previous_value = __pool_size
+    try:
+        pool_size = int(pool_size)
+    except Exception:
+        return previous_value           # simply keep previous value
+    with __session_lock:
+        __pool_size = pool_size
+        if __session is not None:
+            __session.close()
+            __session = None            # recreated on next use
+    return previous_value
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+Copyright (c) 2016 The Broad Institute, Inc.  All rights are reserved.
+
+cache.py: persistent, content-addressed cache of GDC query responses, so
+that repeated tool invocations need not re-issue identical metadata queries
+
+@author: agent
+@date:  2026_10_18
+'''
+
+# }}}
+
+import os
+import json
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+
+class ResponseCache(object):
+    ''' Stores the complete list of hits returned by a GDC query in a file
+    named by the SHA1 digest of the request (endpoint url, parameters and
+    legacy flag).  Entries expire after a per-endpoint time-to-live, and the
+    least recently used entries are evicted when the cache grows larger than
+    max_bytes.  If a datestamp is given, each stored entry is also recorded
+    under that datestamp; when pinned, lookups return the entry recorded for
+    the datestamp regardless of its age, so that re-running a tool for an
+    earlier datestamp sees the same metadata it saw originally.
+    '''
+
+    # Default time-to-live (seconds) of each endpoint; 0 disables caching
+    # of that endpoint.  A cached query is answered with all of its hits at
+    # once, so only endpoints with small answers are cached by default.  File
+    # and case metadata are far too voluminous (and are better streamed, page
+    # by page), so are always queried afresh unless configured otherwise
+    DEFAULT_TTLS = { 'projects'   : 86400,
+                     'programs'   : 86400,
+                     'submission' : 86400,
+                     'cases'      : 0,
+                     'files'      : 0 }
+
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    # The cache is walked for eviction once per process, then each time
+    # another max_bytes / EVICT_FRACTION bytes have been stored
+    EVICT_FRACTION = 16
+
+    def __init__(self, root, max_bytes=None, ttls=None, datestamp=None,
+                 pinned=False):
+        self.root = root
+        self.max_bytes = max_bytes if max_bytes else self.DEFAULT_MAX_BYTES
+        self.ttls = dict(self.DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.datestamp = datestamp
+        self.pinned = pinned and datestamp is not None
+        self.unevicted = self.max_bytes
+
+    def cacheable(self, endpoint):
+        '''Returns True if responses from endpoint may be cached'''
+        return self.ttls.get(endpoint, 0) > 0
+
+    def lookup(self, endpoint, request):
+        '''Return the cached hits for request, or None if there are none,
+        or if they are older than the TTL of endpoint'''
+        key = _digest(request)
+        if self.pinned:
+            path = self._path(key, self.datestamp)
+        else:
+            path = self._path(key)
+
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not self.pinned:
+            age = time.time() - entry['time']
+            if age > self.ttls.get(endpoint, 0):
+                return None
+
+        # Record this use, for least-recently-used eviction
+        _touch(path)
+        logging.debug("GDC query served from cache: " + path)
+        return entry['hits']
+
+    def store(self, endpoint, request, hits):
+        '''Save the hits returned by request, then evict old entries'''
+        key = _digest(request)
+        entry = { 'request' : request,
+                  'endpoint' : endpoint,
+                  'datestamp' : self.datestamp,
+                  'time' : time.time(),
+                  'hits' : hits }
+
+        path = self._path(key)
+        _atomic_json_dump(entry, path)
+        stored = os.path.getsize(path)
+        if self.datestamp:
+            _atomic_json_dump(entry, self._path(key, self.datestamp))
+            stored *= 2
+
+        # Walking the whole cache on every store would be slow
+        self.unevicted += stored
+        if self.unevicted >= self.max_bytes // self.EVICT_FRACTION:
+            self.unevicted = 0
+            self.evict()
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits within
+        max_bytes'''
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _path(self, key, datestamp=None):
+        name = key + '.json' if datestamp is None else \
+               '.'.join([key, datestamp, 'json'])
+        return os.path.join(self.root, key[:2], name)
+
+# Module helpers
+def _digest(request):
+    '''Content address of a request: SHA1 of its canonical JSON encoding'''
+    canonical = json.dumps(request, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def _atomic_json_dump(obj, path):
+    '''Write obj as JSON to a temporary file, then rename it to path, so that
+    concurrent readers never see a partially written entry'''
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.rename(tmp_path, path)
+    finally:
+        # Only left behind if the entry could not be written
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
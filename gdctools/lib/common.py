@@ -9,6 +9,8 @@ import logging
 import re
 import sys
 import contextlib
+import hashlib
+import io
 from argparse import RawDescriptionHelpFormatter, SUPPRESS, OPTIONAL, ZERO_OR_MORE
 from fasteners import InterProcessLock
 
@@ -36,6 +38,20 @@ ANNOT_TO_DATATYPE = {
 }
 
 
+def md5_digest(filename, block_size=8 * 1024 * 1024):
+    '''Return an MD5 hash object updated with the contents of filename,
+    which is read block_size bytes at a time into one reusable buffer'''
+    digest = hashlib.md5()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with io.open(filename, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest
+
 def silent_rm(filename):
     try:
         os.remove(filename)
@@ -60,6 +76,24 @@ def increment_file(filepath):
         filepath = '.'.join((filepath, str(count)))
     return filepath
 
+def merge_sorted(left, right, key=lambda item: item[0]):
+    '''Merge two iterables, each sorted by key without duplicate keys, into
+    one stream of (key, left_item, right_item) triples in key order, where
+    the item missing from either side is None.  Only one item of each side
+    is held in memory at a time.'''
+    left, right = iter(left), iter(right)
+    a, b = next(left, None), next(right, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and key(a) < key(b)):
+            yield key(a), a, None
+            a = next(left, None)
+        elif a is None or key(b) < key(a):
+            yield key(b), None, b
+            b = next(right, None)
+        else:
+            yield key(a), a, b
+            a, b = next(left, None), next(right, None)
+
 def immediate_subdirs(path):
     subdirs = [d for d in os.listdir(path)
             if os.path.isdir(os.path.join(path, d))]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+Copyright (c) 2016 The Broad Institute, Inc.  All rights are reserved.
+
+manifest.py: SQLite index of the files mirrored beneath a program root, so
+that tools can tell which files are mirrored without stat()ing each of them
+and reading its .md5 file
+
+@author: agent
+@date:  2026_10_18
+'''
+
+# }}}
+
+import os
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+
+from lib import meta
+from lib.common import DATESTAMP_REGEX
+
+# One mirrored file: path is relative to the program root, mtime in seconds
+# since the epoch, and first_seen the datestamp of the mirror which first
+# downloaded it
+ManifestEntry = namedtuple('ManifestEntry', ['uuid', 'project', 'path',
+                                             'size', 'md5', 'mtime',
+                                             'first_seen'])
+
+class Manifest(object):
+    ''' Index of the verified files mirrored beneath a program root, stored
+    in <prog_root>/manifest.db and keyed by uuid.  gdc_mirror records each
+    file as it is downloaded, and both it and gdc_dice consult the index
+    instead of the filesystem.  Files mirrored before the index existed are
+    added as they are found on disk; rebuild() recreates the whole index
+    from the mirrored files and metadata, should it be lost or damaged.
+
+    One Manifest may be shared by several threads.
+    '''
+
+    FILE_NAME = 'manifest.db'
+
+    def __init__(self, prog_root):
+        # Paths of callers may be relative to the working directory, so are
+        # compared with the absolute program root
+        self.prog_root = os.path.abspath(prog_root)
+        self.path = os.path.join(prog_root, self.FILE_NAME)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                                 uuid TEXT PRIMARY KEY,
+                                 project TEXT NOT NULL,
+                                 path TEXT NOT NULL,
+                                 size INTEGER,
+                                 md5 TEXT,
+                                 mtime REAL,
+                                 first_seen TEXT)''')
+            self.db.execute('''CREATE INDEX IF NOT EXISTS files_project
+                               ON files (project)''')
+            # MD5 digests computed by gdc_mirror --verify, which remain valid
+            # as long as the file (inode) is unchanged in size and mtime
+            self.db.execute('''CREATE TABLE IF NOT EXISTS md5_cache (
+                                 inode INTEGER,
+                                 size INTEGER,
+                                 mtime REAL,
+                                 md5 TEXT,
+                                 PRIMARY KEY (inode, size, mtime))''')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def record(self, project, uuid, path, size, md5, datestamp, mtime=None):
+        '''Add or update the entry of a mirrored file.  The path may be
+        absolute or relative to the working directory; if mtime is not given
+        it is read from the file.  The first_seen datestamp of an existing
+        entry is preserved.'''
+        path = os.path.abspath(path)
+        if mtime is None:
+            mtime = os.path.getmtime(path)
+        relpath = os.path.relpath(path, self.prog_root)
+        with self.lock, self.db:
+            cursor = self.db.execute('''UPDATE files SET project=?, path=?,
+                                        size=?, md5=?, mtime=? WHERE uuid=?''',
+                                     (project, relpath, size, md5, mtime, uuid))
+            if cursor.rowcount == 0:
+                self.db.execute('INSERT INTO files VALUES (?,?,?,?,?,?,?)',
+                                (uuid, project, relpath, size, md5, mtime,
+                                 datestamp))
+
+    def remove(self, uuids):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM files WHERE uuid=?',
+                                [(uuid,) for uuid in uuids])
+
+    def lookup(self, uuid):
+        '''Return the ManifestEntry of uuid, or None if it is not mirrored'''
+        with self.lock:
+            row = self.db.execute('SELECT * FROM files WHERE uuid=?',
+                                  (uuid,)).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def entries(self, project=None):
+        '''Return a dict of the ManifestEntry of each file mirrored for
+        project (or for all projects), indexed by uuid'''
+        with self.lock:
+            if project is None:
+                rows = self.db.execute('SELECT * FROM files').fetchall()
+            else:
+                rows = self.db.execute('SELECT * FROM files WHERE project=?',
+                                       (project,)).fetchall()
+        return dict((row[0], ManifestEntry(*row)) for row in rows)
+
+    def cached_md5(self, st):
+        '''Return the MD5 digest cached for the file of os.stat() result st,
+        or None if the file has not been hashed since it last changed'''
+        with self.lock:
+            row = self.db.execute('''SELECT md5 FROM md5_cache WHERE
+                                     inode=? AND size=? AND mtime=?''',
+                                  (st.st_ino, st.st_size, st.st_mtime)
+                                  ).fetchone()
+        return row[0] if row else None
+
+    def cache_md5(self, st, md5):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO md5_cache VALUES (?,?,?,?)',
+                            (st.st_ino, st.st_size, st.st_mtime, md5))
+
+    def full_path(self, entry):
+        return os.path.join(self.prog_root, entry.path)
+
+    def is_mirrored(self, file_dict):
+        '''Return True if the file described by file_dict, with its current
+        md5sum, is recorded as mirrored'''
+        entry = self.lookup(file_dict['file_id'])
+        return entry is not None and entry.md5 == file_dict['md5sum']
+
+    def record_from_disk(self, project, file_dict, path, datestamp,
+                         strict=True, snapshot=None):
+        '''Add the entry of a file mirrored before the manifest existed, if
+        it is on disk and its .md5 file matches file_dict.  Returns True if
+        it was recorded.  If a MirrorSnapshot (see lib/meta.py) of the
+        project is given, the file is looked up in that.'''
+        if not meta.md5_matches(file_dict, path + ".md5", strict, snapshot):
+            return False
+        if snapshot is not None:
+            st = snapshot.state(file_dict)
+            size, mtime = st.size, st.mtime
+        elif os.path.isfile(path):
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        else:
+            return False
+        self.record(project, file_dict['file_id'], path, size,
+                    file_dict['md5sum'], datestamp, mtime)
+        return True
+
+    def rebuild(self, strict=True):
+        '''Recreate the manifest from the metadata and mirrored files of each
+        project beneath the program root (see rebuild_project).  Returns the
+        number of files recorded.'''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files')
+
+        count = 0
+        for project in sorted(os.listdir(self.prog_root)):
+            if os.path.isdir(os.path.join(self.prog_root, project, "metadata")):
+                count += self.rebuild_project(project, strict)
+        return count
+
+    def rebuild_project(self, project, strict=True):
+        '''Recreate the entries of one project from its mirrored files and
+        metadata.  Each file is recorded if it is on disk with a matching
+        .md5 file, as first seen on the earliest datestamp whose metadata
+        lists it.  Returns the number of files recorded.'''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files WHERE project=?', (project,))
+
+        proj_root = os.path.join(self.prog_root, project)
+        meta_dir = os.path.join(proj_root, "metadata")
+        datestamps = []
+        if os.path.isdir(meta_dir):
+            datestamps = sorted(d for d in os.listdir(meta_dir)
+                                if DATESTAMP_REGEX.match(d) and
+                                os.path.isdir(os.path.join(meta_dir, d)))
+        recorded = set()
+        snapshot = meta.MirrorSnapshot(proj_root, strict)
+        for datestamp in datestamps:
+            stamp_dir = os.path.join(meta_dir, datestamp)
+            try:
+                metadata = meta.latest_metadata(stamp_dir)
+            except (IndexError, IOError, ValueError):
+                logging.warning("No usable metadata in " + stamp_dir)
+                continue
+            for file_dict in metadata:
+                uuid = file_dict['file_id']
+                if uuid in recorded:
+                    continue
+                path = meta.mirror_path(proj_root, file_dict, strict)
+                if self.record_from_disk(project, file_dict, path,
+                                         datestamp, strict, snapshot):
+                    recorded.add(uuid)
+        logging.info("%d files of %s recorded in %s" % \
+                     (len(recorded), project, self.path))
+        return len(recorded)
@@ -17,15 +17,28 @@ from __future__ import print_function
 
 import os
 import json
+import gzip
+import hashlib
 import sys
 import logging
 import csv
+import tempfile
+import threading
 from lib.common import DATESTAMP_REGEX, ANNOT_TO_DATATYPE
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 
 # Lightweight class to enable handling of aggregate projects
 Case = namedtuple('Case', ['proj_id', 'case_data'])
 
+# State of one mirrored file: size in bytes, mtime in seconds since the
+# epoch, and the first line of its .md5 file (None if it has none)
+FileState = namedtuple('FileState', ['size', 'mtime', 'md5'])
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    _scandir = None         # Python 2: fall back to os.listdir()
+
 def extract_case_data(diced_metadata_file):
     '''Create a case-based lookup of available data types'''
     # Use a case-based dictionary to count each data type on a case/sample basis
@@ -99,24 +112,362 @@ def append_metadata(file_dicts, metafile):
         json.dump(dicts, out, indent=2)
 
 def latest_metadata(stamp_dir):
-    metadata_files = [f for f in os.listdir(stamp_dir)
-                      if os.path.isfile(os.path.join(stamp_dir, f))
-                      and "metadata" in f]
-    # Get the chronologically latest one, in case there is more than one,
-    # Should just be a sanity check
-    latest = sorted(metadata_files)[-1]
-    latest = os.path.join(stamp_dir, latest)
-    with open(latest) as jsonf:
+    '''Return the file metadata of <proj_dir>/metadata/<datestamp>, whether
+    stored in full or as a delta (see read_project_metadata)'''
+    stamp_dir = os.path.normpath(stamp_dir)
+    proj_dir = os.path.dirname(os.path.dirname(stamp_dir))
+    return read_project_metadata(proj_dir, os.path.basename(stamp_dir))
+
+def _snapshot_files(stamp_dir):
+    '''Return the full metadata JSON files and the delta files of a
+    datestamp folder, each sorted by name'''
+    if not os.path.isdir(stamp_dir):
+        return [], []
+    names = sorted(f for f in os.listdir(stamp_dir)
+                   if os.path.isfile(os.path.join(stamp_dir, f))
+                   and f.endswith(".json"))
+    full = [os.path.join(stamp_dir, f) for f in names if "metadata" in f]
+    deltas = [os.path.join(stamp_dir, f) for f in names
+              if f.startswith("delta.")]
+    return full, deltas
+
+def has_metadata(proj_dir, datestamp):
+    '''Return True if metadata of the datestamp is stored, in full or as a
+    delta'''
+    full, deltas = _snapshot_files(os.path.join(proj_dir, "metadata",
+                                                datestamp))
+    return bool(full or deltas)
+
+# Materialized metadata snapshots, most recently used last, indexed by
+# (project folder, datestamp)
+__snapshots = OrderedDict()
+__snapshots_lock = threading.Lock()
+SNAPSHOT_CACHE_SIZE = 4
+
+def read_project_metadata(proj_dir, datestamp):
+    '''Return the list of file dicts mirrored for a project on a datestamp.
+
+    Metadata is stored either in full, as metadata.<project>.<datestamp>.json
+    (see write_metadata), or as a delta from the metadata of an earlier
+    datestamp, in delta.<project>.<datestamp>.json (see
+    write_project_metadata).  Deltas are materialized by applying them to
+    their parent, recursively, so the datestamp folders of a chain must be
+    retained together.  The last few snapshots read are cached, so walking
+    a chain of datestamps in order materializes each only once.'''
+    key = (os.path.abspath(proj_dir), datestamp)
+    with __snapshots_lock:
+        if key in __snapshots:
+            metadata = __snapshots.pop(key)
+            __snapshots[key] = metadata
+            return list(metadata)
+
+    stamp_dir = os.path.join(proj_dir, "metadata", datestamp)
+    full, deltas = _snapshot_files(stamp_dir)
+    if full:
+        # The latest one, in case there is more than one (sanity check)
+        metadata = read_metadata(full[-1])
+    elif deltas:
+        with open(deltas[-1]) as df:
+            delta = json.load(df)
+        if delta['parent'] >= datestamp:
+            raise ValueError("Invalid parent of delta " + deltas[-1])
+        metadata = merge_metadata(read_project_metadata(proj_dir,
+                                                        delta['parent']),
+                                  delta['changed'], delta['removed'])
+    else:
+        raise IOError("No metadata found in " + stamp_dir)
+
+    with __snapshots_lock:
+        __snapshots[key] = metadata
+        while len(__snapshots) > SNAPSHOT_CACHE_SIZE:
+            __snapshots.popitem(last=False)
+    return list(metadata)
+
+def _index_file(proj_dir, datestamp):
+    project = os.path.basename(os.path.normpath(proj_dir))
+    return os.path.join(proj_dir, "metadata", datestamp,
+                        ".".join(["index", project, datestamp, "tsv"]))
+
+def metadata_index(proj_dir, datestamp):
+    '''Generate the rows of the index of the metadata of a datestamp, as
+    tuples of
+        uuid  md5sum  data_category  data_type  file_name  digest
+    sorted by uuid, where digest is the MD5 of the whole file dict, so that
+    indexes of two datestamps can be compared in a single streaming pass to
+    find the files added, removed or changed.  The index is made if need
+    be, then kept in the datestamp folder and read a line at a time (see
+    read_metadata_index); if that folder is read-only, the rows made are
+    generated from memory instead.'''
+    index_file = _index_file(proj_dir, datestamp)
+    if not os.path.isfile(index_file):
+        rows = _metadata_index_rows(proj_dir, datestamp)
+        try:
+            _write_metadata_index(index_file, rows)
+        except (IOError, OSError) as e:
+            logging.info("Could not keep metadata index %s: %s" % \
+                         (index_file, str(e)))
+            return iter(rows)
+    return read_metadata_index(index_file)
+
+def _metadata_index_rows(proj_dir, datestamp):
+    rows = []
+    for fd in read_project_metadata(proj_dir, datestamp):
+        text = json.dumps(fd, sort_keys=True, separators=(',', ':'))
+        digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+        rows.append((fd['file_id'], fd.get('md5sum', ''),
+                     fd.get('data_category', ''), fd.get('data_type', ''),
+                     fd.get('file_name', ''), digest))
+    rows.sort()
+    return rows
+
+def _write_metadata_index(index_file, rows):
+    # Written without the mirror lock, so each writer has its own temporary
+    # file, and the index appears complete or not at all
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(index_file),
+                                prefix=os.path.basename(index_file) + ".")
+    try:
+        with os.fdopen(fd, 'w') as xf:
+            for row in rows:
+                xf.write("\t".join(row) + "\n")
+        os.rename(temp, index_file)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def read_metadata_index(index_file):
+    '''Generate the rows of a metadata index file (see metadata_index), as
+    tuples, one line at a time'''
+    with open(index_file) as xf:
+        for line in xf:
+            yield tuple(line.rstrip('\n').split('\t'))
+
+def metadata_depth(proj_dir, datestamp):
+    '''Return the number of deltas to be applied to a full snapshot in order
+    to materialize the metadata of datestamp (0 if it is stored in full)'''
+    full, deltas = _snapshot_files(os.path.join(proj_dir, "metadata",
+                                                datestamp))
+    if full or not deltas:
+        return 0
+    with open(deltas[-1]) as df:
+        return json.load(df).get('depth', 1)
+
+def write_project_metadata(proj_dir, datestamp, file_metadata, parent=None,
+                           max_deltas=0, compact=False):
+    '''Store the file metadata of a project on a datestamp: as a delta from
+    the metadata of the earlier datestamp parent, i.e. the file dicts added
+    or changed since and the uuids removed, unless that would make a chain
+    of more than max_deltas deltas; otherwise in full, optionally with its
+    compact companion (see write_metadata).  Returns the path written.'''
+    project = os.path.basename(os.path.normpath(proj_dir))
+    stamp_dir = os.path.join(proj_dir, "metadata", datestamp)
+    if not os.path.isdir(stamp_dir):
+        os.makedirs(stamp_dir)
+    meta_json = os.path.join(stamp_dir, ".".join(["metadata", project,
+                                                  datestamp, "json"]))
+    delta_json = os.path.join(stamp_dir, ".".join(["delta", project,
+                                                   datestamp, "json"]))
+
+    depth = 0
+    if parent is not None and parent < datestamp and max_deltas > 0:
+        depth = metadata_depth(proj_dir, parent) + 1
+        if depth > max_deltas:
+            depth = 0
+
+    # Files of a previous run on this datestamp must not be read instead
+    stale = [delta_json] if depth == 0 else \
+            [meta_json, compact_metadata_file(meta_json)]
+    stale.append(_index_file(proj_dir, datestamp))
+    for path in stale:
+        if os.path.exists(path):
+            os.remove(path)
+    with __snapshots_lock:
+        __snapshots.pop((os.path.abspath(proj_dir), datestamp), None)
+
+    if depth == 0:
+        write_metadata(meta_json, file_metadata, compact)
+        return meta_json
+
+    previous = dict((fd['file_id'], fd)
+                    for fd in read_project_metadata(proj_dir, parent))
+    current = set(fd['file_id'] for fd in file_metadata)
+    delta = { 'parent' : parent,
+              'depth' : depth,
+              'changed' : [fd for fd in file_metadata
+                           if previous.get(fd['file_id']) != fd],
+              'removed' : sorted(uuid for uuid in previous
+                                 if uuid not in current) }
+    with open(delta_json + ".tmp", 'w') as df:
+        json.dump(delta, df, separators=(',', ':'))
+    os.rename(delta_json + ".tmp", delta_json)
+    return delta_json
+
+def compact_metadata_file(json_file):
+    '''Return the path of the compact companion of a metadata JSON file'''
+    base = json_file[:-len(".json")] if json_file.endswith(".json") \
+           else json_file
+    return base + ".jsonl.gz"
+
+def write_metadata(json_file, file_metadata, compact=False):
+    '''Write a list of file dicts to json_file and, if compact is True, to a
+    compact companion as well: gzipped JSON lines, one file dict apiece.
+    The companion is renamed into place once written, so that when present
+    it is complete.'''
+    with open(json_file, 'w') as jf:
+        json.dump(file_metadata, jf, indent=2)
+
+    data_file = compact_metadata_file(json_file)
+    if not compact:
+        # Never leave a stale companion to be preferred over the JSON
+        if os.path.exists(data_file):
+            os.remove(data_file)
+        return
+
+    with gzip.open(data_file + ".tmp", 'wb') as gz:
+        for fd in file_metadata:
+            line = json.dumps(fd, separators=(',', ':')) + "\n"
+            gz.write(line.encode('utf-8'))
+    os.rename(data_file + ".tmp", data_file)
+
+def read_metadata(json_file):
+    '''Return the list of file dicts in a metadata JSON file, read from its
+    compact companion (see write_metadata) when there is one'''
+    data_file = compact_metadata_file(json_file)
+    if os.path.isfile(data_file):
+        try:
+            with gzip.open(data_file, 'rb') as gz:
+                lines = gz.read().decode('utf-8')
+            # Parsing all lines as one array is much quicker than one by one
+            # (JSON lines cannot contain raw newlines)
+            return json.loads('[' + lines.rstrip('\n').replace('\n', ',') + ']')
+        except (IOError, EOFError, ValueError) as e:
+            logging.warning("Unreadable %s (%s), reading %s instead" % \
+                            (data_file, str(e), json_file))
+    with open(json_file) as jsonf:
         return json.load(jsonf)
 
-def files_diff(proj_root, new_files, old_files, strict=True):
+def files_diff(proj_root, new_files, old_files, strict=True, manifest=None,
+               snapshot=None):
     '''Returns the file dicts in new_files that aren't in old_files.
     Also checks that the file is present on disk.'''
-    old_uuids = {fd['file_id'] for fd in old_files
-                if os.path.isfile(mirror_path(proj_root, fd, strict))}
+    old_uuids = mirrored_uuids(proj_root, old_files, strict, manifest,
+                               snapshot)
     new_dicts = [fd for fd in new_files if fd['file_id'] not in old_uuids]
     return new_dicts
 
+def mirrored_uuids(proj_root, old_files, strict=True, manifest=None,
+                   snapshot=None):
+    '''Returns the set of uuids in old_files that are present on disk, so that
+    new file dicts may be checked against it one at a time (e.g. as they are
+    streamed from GDC).  If a Manifest (see lib/manifest.py) is given, files
+    recorded in it are not looked for on disk.  Other files are looked up in
+    a MirrorSnapshot of proj_root, made here if none is given.'''
+    recorded = dict()
+    if manifest is not None:
+        recorded = manifest.entries(os.path.basename(proj_root))
+    if snapshot is None:
+        snapshot = MirrorSnapshot(proj_root, strict)
+    return {fd['file_id'] for fd in old_files
+            if fd['file_id'] in recorded or snapshot.exists(fd)}
+
+class MirrorSnapshot(object):
+    ''' The files mirrored beneath a project root, as seen by a single
+    directory scan of each <category>/<data_type> folder, so that thousands
+    of files can be looked up without a stat() or open() apiece.  Folders
+    are scanned when first looked into.  The size and mtime of a file, and
+    the first line of its .md5 file, are only read when its state() is
+    asked for, then kept in a map indexed by uuid.
+
+    Files written after their folder was scanned are not seen.  One
+    snapshot may be shared by several threads.
+    '''
+
+    def __init__(self, proj_root, strict=True):
+        self.proj_root = proj_root
+        self.strict = strict
+        self.lock = threading.Lock()
+        self.folders = dict()
+        self.files = dict()
+
+    def path(self, file_dict):
+        return mirror_path(self.proj_root, file_dict, self.strict)
+
+    def exists(self, file_dict):
+        '''Returns True if the file of file_dict is on disk'''
+        folder, name = os.path.split(self.path(file_dict))
+        return name in self._listing(folder)
+
+    def state(self, file_dict):
+        '''Returns the FileState of the file of file_dict, or None if it is
+        not on disk'''
+        uuid = file_dict['file_id']
+        state = self.files.get(uuid)
+        if state is None:
+            path = self.path(file_dict)
+            folder, name = os.path.split(path)
+            listing = self._listing(folder)
+            if name not in listing:
+                return None
+            entry = listing[name]
+            st = entry.stat() if entry is not None else os.stat(path)
+            md5 = None
+            if name + ".md5" in listing:
+                with open(path + ".md5") as md5f:
+                    md5 = md5f.readline()
+            state = FileState(st.st_size, st.st_mtime, md5)
+            self.files[uuid] = state
+        return state
+
+    def _listing(self, folder):
+        '''Return the regular files of folder, as a dict mapping each name to
+        its DirEntry (None without os.scandir), scanning it if need be'''
+        with self.lock:
+            listing = self.folders.get(folder)
+            if listing is None:
+                listing = _scan_folder(folder)
+                self.folders[folder] = listing
+        return listing
+
+def _scan_folder(folder):
+    try:
+        if _scandir is None:
+            return dict((name, None) for name in os.listdir(folder))
+        return dict((e.name, e) for e in _scandir(folder) if e.is_file())
+    except OSError:
+        return dict()               # Nothing mirrored there yet
+
+def merge_metadata(old_files, changed_files, removed_uuids=()):
+    '''Apply incremental changes to a list of file dicts: file dicts in
+    changed_files replace (or are added to) those in old_files with the same
+    uuid, and those whose uuid is in removed_uuids are dropped.  The result
+    is ordered by data category, then uuid, as a full mirror would be.'''
+    merged = dict((fd['file_id'], fd) for fd in old_files)
+    for fd in changed_files:
+        merged[fd['file_id']] = fd
+    for uuid in removed_uuids:
+        merged.pop(uuid, None)
+    return sorted(merged.values(),
+                  key=lambda fd: (fd['data_category'], fd['file_id']))
+
+def sync_file(stamp_dir, project, datestamp):
+    '''Path of the file recording when the metadata in stamp_dir was
+    synchronized with the GDC, and which files were removed since the
+    previous sync'''
+    return os.path.join(stamp_dir, ".".join(["sync", project, datestamp,
+                                             "json"]))
+
+def write_sync_record(stamp_dir, project, datestamp, record):
+    with open(sync_file(stamp_dir, project, datestamp), 'w') as sf:
+        json.dump(record, sf, indent=2)
+
+def read_sync_record(stamp_dir, project, datestamp):
+    '''Return the sync record of a datestamp, or None if there is none
+    (e.g. because that mirror predates incremental syncing)'''
+    path = sync_file(stamp_dir, project, datestamp)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as sf:
+        return json.load(sf)
+
 def latest_datestamp(proj_dir, date_prefix=None, ignore=None):
     '''Get the timestamp of the last mirror or dicer run for a project.
 
@@ -152,18 +503,45 @@ def latest_prog_timestamp(prog_dir, date_prefix=None, ignore=None):
     else:
         return sorted(proj_timestamps)[-1]
 
-def md5_matches(file_dict, md5file, strict=True):
-    """Returns true if the one-line md5file matches the md5 data in file_dict"""
-    if not os.path.isfile(md5file):
-        return False
+def md5_matches(file_dict, md5file, strict=True, snapshot=None):
+    """Returns true if the one-line md5file matches the md5 data in file_dict.
+    If a MirrorSnapshot is given, the md5file of the mirrored file is read
+    from that, instead of being looked for on disk."""
     filename = file_basename(file_dict, strict)
     md5_basename = os.path.basename(md5file)
     if filename + ".md5" != md5_basename: return False
 
-    with open(md5file) as md5f:
-        line = md5f.next()
-        md5value, fname = line.strip().split('  ')
-        return fname == filename and md5value == file_dict['md5sum']
+    if snapshot is not None:
+        state = snapshot.state(file_dict)
+        line = state.md5 if state is not None else None
+    elif os.path.isfile(md5file):
+        with open(md5file) as md5f:
+            line = md5f.readline()
+    else:
+        line = None
+    if not line:
+        return False
+    md5value, fname = line.strip().split('  ')
+    return fname == filename and md5value == file_dict['md5sum']
+
+def read_md5_file(md5file):
+    """Returns the md5 value recorded in an md5file, or None if it is absent
+    or unreadable"""
+    try:
+        with open(md5file) as md5f:
+            return md5f.readline().split()[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+def write_md5_file(md5file, md5sum, filename, size=None):
+    """Write the md5sum-compatible checksum file of a verified download,
+    noting its size on a comment line.  The file is written under a
+    temporary name, then renamed, so it is never seen partially written."""
+    with open(md5file + ".tmp", 'w') as md5f:
+        md5f.write(md5sum + "  " + filename + "\n")
+        if size is not None:
+            md5f.write("# size: " + str(size) + "\n")
+    os.rename(md5file + ".tmp", md5file)
 
 __SUPPORTED_FILE_TYPES__ = {'xml', 'txt', 'tar', 'gz', 'md5', 'xlsx', 'xls'}
 
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+Copyright (c) 2016 The Broad Institute, Inc.  All rights are reserved.
+
+store.py: content-addressed store of mirrored files, keyed by md5, of which
+mirror locations are hardlinked views, so that each distinct file is stored
+and downloaded only once
+
+@author: agent
+@date:  2026_10_18
+'''
+
+# }}}
+
+import os
+import errno
+import logging
+import threading
+
+from lib import common
+
+class ObjectStore(object):
+    ''' Verified files, stored once each as <root>/objects/<md5[:2]>/<md5>.
+    A file mirrored to several places (e.g. the same GDC file in several
+    projects or mirror roots) is a hardlink to its object in each, so its
+    bytes are held once, and a file whose bytes are already in the store
+    need not be downloaded again.  The store must therefore be on the same
+    file system as the mirror.
+
+    An object is referenced only by its hardlinks, so once no mirrored file
+    links to it (its link count is 1) gc() may remove it.  Mirrored files
+    are shared with the store, so must never be modified in place.
+
+    Objects are trusted by name: they are verified when added, but not
+    re-hashed when linked, so a damaged object spreads to the files later
+    linked to it.  Adding a verified download with the same md5 (e.g. by
+    gdc_mirror --force-download, which does not link from the store)
+    replaces the object; other files still linking to the damaged copy are
+    repaired as they are downloaded again.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        common.safeMakeDirs(self.objects)
+
+    def path(self, md5):
+        return os.path.join(self.objects, md5[:2], md5)
+
+    def size(self, md5):
+        '''Return the size of the object with this md5, or None if absent'''
+        try:
+            return os.stat(self.path(md5)).st_size
+        except OSError:
+            return None
+
+    def add(self, file_path, md5):
+        '''Store a verified file, whose md5 is given, unless it already is
+        the object with that md5.  Any other object with that md5 is
+        replaced, as the fresh file may be a repaired copy of it (see
+        above).  Returns True if file_path was stored.'''
+        obj = self.path(md5)
+        common.safeMakeDirs(os.path.dirname(obj))
+        try:
+            os.link(file_path, obj)
+            return True
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if os.path.samefile(file_path, obj):
+            return False
+        # Several threads or processes may be replacing the same object
+        temp = "%s.%d.%d" % (obj, os.getpid(), threading.current_thread().ident)
+        common.silent_rm(temp)
+        os.link(file_path, temp)
+        os.rename(temp, obj)
+        return True
+
+    def link(self, md5, dest):
+        '''Make dest a hardlink to the object with this md5, replacing any
+        file already there'''
+        temp = dest + ".link"
+        common.silent_rm(temp)
+        common.safe_make_hardlink(self.path(md5), temp)
+        # Renaming replaces dest atomically, so readers never miss it
+        os.rename(temp, dest)
+
+    def same_file_system(self, path):
+        '''Return True if path is on the file system of the store, as it must
+        be for hardlinks to it to be made'''
+        return os.stat(path).st_dev == os.stat(self.objects).st_dev
+
+    def gc(self, dry_run=False):
+        '''Remove the objects no longer linked from anywhere else.  Returns the
+        number of objects and of bytes removed (or which would be, if
+        dry_run is True).'''
+        count = size = 0
+        for folder in common.immediate_subdirs(self.objects):
+            folder = os.path.join(self.objects, folder)
+            for name in os.listdir(folder):
+                obj = os.path.join(folder, name)
+                st = os.stat(obj)
+                if st.st_nlink > 1:
+                    continue
+                logging.info("Removing unreferenced object " + obj)
+                if not dry_run:
+                    os.remove(obj)
+                count += 1
+                size += st.st_size
+        return count, size
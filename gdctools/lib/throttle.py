@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+Copyright (c) 2016 The Broad Institute, Inc.  All rights are reserved.
+
+throttle.py: bandwidth and connection budget shared by all downloads of a
+tool invocation, so that mirroring can be kept from saturating the network
+
+@author: agent
+@date:  2026_10_18
+'''
+
+# }}}
+
+import re
+import time
+import threading
+import contextlib
+
+class Throttle(object):
+    ''' Limits the aggregate download rate with a token bucket, and the number
+    of concurrent download connections with a counting budget.  A rate or
+    connection limit of 0 (or None) means unlimited.
+
+    The rate may vary with the time of day: profiles is a list of
+    (start, end, rate) triples, where start and end are minutes past local
+    midnight (a range may wrap past midnight), and the rate of the first
+    range containing the current time overrides the default rate.
+    '''
+
+    def __init__(self, rate=0, max_connections=0, profiles=None):
+        self.default_rate = rate or 0
+        self.profiles = profiles or []
+        self.max_connections = max_connections or 0
+        self.lock = threading.Lock()
+        self.available = threading.Condition(threading.Lock())
+        self.in_use = 0
+        self.tokens = 0.0
+        self.last = time.time()
+
+    def limits_rate(self):
+        '''Return True if a rate limit may be in effect at any time of day'''
+        return self.default_rate > 0 or any(p[2] > 0 for p in self.profiles)
+
+    def rate(self):
+        '''Return the rate limit (bytes/sec) now in effect, 0 if none'''
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.profiles:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.default_rate
+
+    def consume(self, nbytes):
+        '''Account for nbytes of downloaded data, sleeping as long as needed
+        to keep within the rate limit.  Tokens accrue at the rate limit, up
+        to one second's worth; a shortfall puts the bucket in debt, which
+        the caller sleeps off, so chunks may be larger than the bucket.'''
+        rate = self.rate()
+        if rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(rate, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= nbytes
+            debt = -self.tokens
+        if debt > 0:
+            time.sleep(debt / float(rate))
+
+    def connections(self, n=1):
+        '''Reserve at most n connections, blocking until they are available.
+        Returns the number reserved: n, capped at the connection limit.'''
+        if self.max_connections > 0:
+            n = min(n, self.max_connections)
+        with self.available:
+            while self.max_connections > 0 and \
+                            self.in_use + n > self.max_connections:
+                self.available.wait()
+            self.in_use += n
+        return n
+
+    def release(self, n=1):
+        with self.available:
+            self.in_use -= n
+            self.available.notify_all()
+
+    @contextlib.contextmanager
+    def connection(self, n=1):
+        '''Context manager which reserves connections (see connections()),
+        yielding the number reserved'''
+        n = self.connections(n)
+        try:
+            yield n
+        finally:
+            self.release(n)
+
+_UNITS = { '' : 1, 'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3 }
+
+def parse_rate(text):
+    '''Parse a rate in bytes/sec, with optional K, M or G suffix (e.g. 500K)'''
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', str(text),
+                     re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid rate: " + str(text))
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+def parse_profiles(text):
+    '''Parse time-of-day rate profiles, of the form
+            08:00-20:00=2M, 20:00-08:00=0
+    into a list of (start, end, rate) triples, as expected by Throttle'''
+    profiles = []
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        match = re.match(r'^\s*(\d\d?):(\d\d)\s*-\s*(\d\d?):(\d\d)\s*=(.*)$',
+                         item)
+        if not match:
+            raise ValueError("Invalid rate profile: " + item.strip())
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        profiles.append((start, end, parse_rate(match.group(5))))
+    return profiles
@@ -38,6 +38,7 @@ setup(
 			'gdc_dice = gdctools.gdc_dice:main',
 			'gdc_list = gdctools.gdc_list:main',
 			'gdc_mirror = gdctools.gdc_mirror:main',
+            'gdc_diff = gdctools.gdc_diff:main',
             'gdc_loadfile = gdctools.gdc_loadfile:main',
             'gdc_report = gdctools.gdc_report:main'
 		]
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+Copyright (c) 2016 The Broad Institute, Inc.  All rights are reserved.
+
+fakegdc.py: a small, local stand-in for the GDC API, so that GDCtools can be
+tested offline, through their real HTTP code paths.  It serves the projects,
+cases and files endpoints (with filters, sorting & paging), single file
+downloads (with byte ranges) and bulk downloads, from a set of fake projects.
+
+@author: agent
+@date:  2026_10_18
+'''
+
+# }}}
+
+from __future__ import print_function
+import os
+import sys
+import io
+import json
+import gzip
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# Make the GDCtools modules importable as the tools themselves import them
+GDCTOOLS = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..",
+                                        "gdctools"))
+if GDCTOOLS not in sys.path:
+    sys.path.insert(0, GDCTOOLS)
+
+import lib.api as api
+
+# Number of files of each data category in each fake project
+CATEGORIES = { 'Biospecimen' : 5, 'Clinical' : 3, 'Copy Number Variation' : 4 }
+
+SORT_FIELDS = { 'files' : 'file_id', 'cases' : 'case_id',
+                'projects' : 'project_id' }
+
+def make_files(project, categories=None):
+    '''Return the file dicts of a fake project, each with its '_content'.
+    The content of the n-th file of a category is the same in every project
+    (as the GDC shares some files between projects), but its uuid is not.'''
+    files = []
+    for category, count in sorted((categories or CATEGORIES).items()):
+        abbrev = category[:3].lower()
+        for n in range(count):
+            content = (('%s file %d\n' % (category, n)) * (50 + n)).encode()
+            files.append({
+                'file_id' : '%s-%s-%04d' % (project.lower(), abbrev, n),
+                'file_name' : '%s.%d.txt' % (abbrev, n),
+                'data_category' : category,
+                'data_type' : category + ' Type',
+                'data_format' : 'BCR XML' if category == 'Clinical' else 'TXT',
+                'access' : 'open',
+                'md5sum' : hashlib.md5(content).hexdigest(),
+                'file_size' : len(content),
+                'updated_datetime' : '2017-01-01T00:00:00',
+                'cases' : [{ 'submitter_id' : 'TCGA-XX-%04d' % n,
+                             'project' : { 'project_id' : project },
+                             'samples' : [{ 'sample_type' : 'Primary Tumor' }]
+                          }],
+                '_content' : content })
+    return files
+
+def set_content(file_dict, content):
+    '''Change the content of a fake file, as a new GDC release would'''
+    file_dict['_content'] = content
+    file_dict['md5sum'] = hashlib.md5(content).hexdigest()
+    file_dict['file_size'] = len(content)
+    file_dict['updated_datetime'] = '2099-01-01T00:00:00'
+
+class FakeGDC(ThreadingMixIn, HTTPServer):
+    ''' Serves the fake projects given as a dict, mapping each project_id to
+    its list of file dicts (see make_files), on a local port.  The requests
+    served are logged, as (method, path, client port) tuples, in requests.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, projects):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.projects = projects
+        self.requests = []
+        self.lock = threading.Lock()
+        # Compress (and chunk) JSON responses, as the GDC does when asked
+        self.compress = False
+        # UUIDs of files served with corrupted content
+        self.broken = set()
+        # Whether Range headers are honored, and the offsets requested
+        self.ranges = True
+        self.offsets = []
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval' : 0.05})
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def files(self):
+        return dict((fd['file_id'], fd) for files in self.projects.values()
+                    for fd in files)
+
+    def data_requests(self):
+        return [r for r in self.requests if r[1].startswith('/data')]
+
+    def hits(self, endpoint, filters):
+        if endpoint == 'projects':
+            docs = [{ 'project_id' : project,
+                      'program' : { 'name' : project.split('-')[0] },
+                      'summary' : _summary(files) }
+                    for project, files in self.projects.items()]
+        elif endpoint == 'cases':
+            cases = dict()
+            for project, files in self.projects.items():
+                for fd in files:
+                    for case in fd['cases']:
+                        case_id = project + ':' + case['submitter_id']
+                        cases[case_id] = dict(case, case_id=case_id)
+            docs = list(cases.values())
+        else:
+            docs = [_public(fd) for files in self.projects.values()
+                    for fd in files]
+        docs = [d for d in docs if filters is None or
+                _match(filters, d, endpoint)]
+        return sorted(docs, key=lambda d: d[SORT_FIELDS[endpoint]])
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._serve('GET', None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._serve('POST', json.loads(self.rfile.read(length).decode('utf-8')))
+
+    def _serve(self, method, body):
+        url = urlparse(self.path)
+        path = url.path
+        with self.server.lock:
+            self.server.requests.append((method, path, self.client_address[1]))
+        parts = path.strip('/').split('/')
+        if parts[0] == 'legacy':
+            parts = parts[1:]
+        endpoint = parts[0]
+
+        if endpoint == 'data' and len(parts) == 2:
+            return self._send_file(parts[1])
+        if endpoint == 'data':
+            return self._send_bulk(body['ids'])
+
+        if body is None:
+            body = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        filters = body.get('filters')
+        if isinstance(filters, str) or (sys.version_info[0] == 2 and
+                                        isinstance(filters, basestring)):
+            filters = json.loads(filters)
+        hits = self.server.hits(endpoint, filters)
+        start = int(body.get('from', 1)) - 1
+        size = int(body.get('size', 10))
+        page = { 'data' : { 'hits' : hits[start:start + size],
+                            'pagination' : { 'total' : len(hits),
+                                             'from' : start + 1,
+                                             'size' : size } },
+                 'warnings' : {} }
+        self._send_json(page)
+
+    def _send_json(self, obj):
+        data = json.dumps(obj).encode('utf-8')
+        accepts = self.headers.get('Accept-Encoding') or ''
+        if not (self.server.compress and 'gzip' in accepts):
+            return self._send(200, data, {'Content-Type' : 'application/json'})
+
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+            gz.write(data)
+        data = buf.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(data), 1000):
+            chunk = data[start:start + 1000]
+            self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii'))
+            self.wfile.write(chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_file(self, uuid):
+        file_dict = self.server.files().get(uuid)
+        if file_dict is None:
+            return self._send(404, b'', {})
+        content = file_dict['_content']
+        if uuid in self.server.broken:
+            content = content[::-1]
+        byte_range = self.headers.get('Range')
+        if byte_range and self.server.ranges:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            with self.server.lock:
+                self.server.offsets.append(start)
+            headers = { 'Content-Range' : 'bytes %d-%d/%d' % \
+                            (start, len(content) - 1, len(content)) }
+            return self._send(206, content[start:], headers)
+        self._send(200, content, {})
+
+    def _send_bulk(self, uuids):
+        files = self.server.files()
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+            for uuid in uuids:
+                content = files[uuid]['_content']
+                info = tarfile.TarInfo(uuid + '/' + files[uuid]['file_name'])
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        self._send(200, buf.getvalue(), {})
+
+    def _send(self, status, data, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def _public(file_dict):
+    return dict((k, v) for k, v in file_dict.items() if not k.startswith('_'))
+
+def _summary(files):
+    counts = dict()
+    for fd in files:
+        counts[fd['data_category']] = counts.get(fd['data_category'], 0) + 1
+    return { 'file_count' : len(files),
+             'data_categories' : [{ 'data_category' : c, 'file_count' : n }
+                                  for c, n in sorted(counts.items())] }
+
+def _values(doc, path):
+    '''All values at a dotted path of doc, descending into lists'''
+    if isinstance(doc, list):
+        return [v for d in doc for v in _values(d, path)]
+    if not path:
+        return [doc]
+    if not isinstance(doc, dict) or path[0] not in doc:
+        return []
+    return _values(doc[path[0]], path[1:])
+
+def _match(filt, doc, endpoint):
+    op = filt['op'].lower()
+    content = filt['content']
+    if op == 'and':
+        return all(_match(f, doc, endpoint) for f in content)
+    if op == 'or':
+        return any(_match(f, doc, endpoint) for f in content)
+    field = content['field']
+    if field.startswith(endpoint + '.'):
+        field = field[len(endpoint) + 1:]
+    values = _values(doc, field.split('.'))
+    wanted = content['value']
+    if op in ('=', 'in'):
+        wanted = wanted if isinstance(wanted, list) else [wanted]
+        return any(v in wanted for v in values)
+    if op == '>':
+        return any(v > wanted for v in values)
+    raise ValueError("Unsupported filter op: " + op)
+
+class GDCTestCase(unittest.TestCase):
+    ''' Runs each test against a fresh FakeGDC (serving self.projects, by
+    default a single project) and in a fresh temporary directory, restoring
+    the global state of lib.api afterwards '''
+
+    def fake_projects(self):
+        return { 'TCGA-FAKE' : make_files('TCGA-FAKE') }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='gdctools-test.')
+        self.gdc = FakeGDC(self.fake_projects()).start()
+        self.saved = (api.GDCQuery.GDC_ROOT, api.get_cache(),
+                      api.get_throttle(), api.get_file_profile(),
+                      api.get_legacy(), api.MAX_RETRIES, api.BACKOFF_BASE)
+        api.GDCQuery.GDC_ROOT = self.gdc.url
+        api.set_pool_size(10)           # fresh session, for this server
+        api.MAX_RETRIES = 1
+        api.BACKOFF_BASE = 0.01
+        self.handlers = list(logging.getLogger().handlers)
+
+    def tearDown(self):
+        (api.GDCQuery.GDC_ROOT, cache, throttle, profile, legacy,
+         api.MAX_RETRIES, api.BACKOFF_BASE) = self.saved
+        api.set_cache(cache)
+        api.set_throttle(throttle)
+        api.set_file_profile(profile)
+        api.set_legacy(legacy)
+        api.set_pool_size(10)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if handler not in self.handlers:
+                root.removeHandler(handler)
+                handler.close()
+        self.gdc.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def path(self, *parts):
+        return os.path.join(self.tmpdir, *parts)
+
+    def write_config(self, mirror_options=None, name='test.cfg'):
+        '''Write a config file rooted in the temporary directory, with the
+        given [mirror] options, and return its path'''
+        lines = ['[DEFAULT]',
+                 'ROOT_DIR: ' + self.tmpdir,
+                 'LOG_DIR: %(ROOT_DIR)s/logs',
+                 'PROGRAMS: TCGA',
+                 '',
+                 '[mirror]',
+                 'DIR: %(ROOT_DIR)s/mirror']
+        for option, value in sorted((mirror_options or {}).items()):
+            lines.append('%s: %s' % (option.upper(), value))
+        lines += ['', '[dice]', 'DIR: %(ROOT_DIR)s/dice']
+        cfg = self.path(name)
+        with open(cfg, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return cfg
+
+    def run_tool(self, tool_class, *args):
+        '''Run a GDCtool with the given command line arguments (positional
+        arguments first), returning the tool'''
+        saved_argv = sys.argv
+        sys.argv = [tool_class.__name__] + list(args)
+        try:
+            tool = tool_class()
+            tool.has_cURL = False
+            tool.execute()
+        finally:
+            sys.argv = saved_argv
+        return tool
+
+    def run_mirror(self, *args, **mirror_options):
+        import gdc_mirror
+        cfg = self.write_config(mirror_options)
+        return self.run_tool(gdc_mirror.gdc_mirror, '--no-cache',
+                             '--config', cfg, *args)
+
+    def project_dir(self, project='TCGA-FAKE'):
+        return self.path('mirror', project.split('-')[0], project)
+
+    def mirrored_files(self, project='TCGA-FAKE'):
+        '''Return the data files mirrored for project, indexed by name'''
+        found = dict()
+        for dirpath, dirnames, filenames in os.walk(self.project_dir(project)):
+            dirnames[:] = [d for d in dirnames if d != 'metadata']
+            for name in filenames:
+                if name.endswith('.txt'):
+                    found[name] = os.path.join(dirpath, name)
+        return found
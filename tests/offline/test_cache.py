@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of the GDC query response cache'''
+
+import os
+import unittest
+
+from fakegdc import GDCTestCase, make_files
+import lib.api as api
+from lib.cache import ResponseCache
+
+class CountingCache(ResponseCache):
+    def __init__(self, *args, **kwargs):
+        super(CountingCache, self).__init__(*args, **kwargs)
+        self.walks = 0
+
+    def evict(self):
+        self.walks += 1
+        super(CountingCache, self).evict()
+
+def cached_entries(root):
+    return [os.path.join(d, f) for d, _, files in os.walk(root)
+            for f in files if f.endswith('.json')]
+
+class TestResponseCache(GDCTestCase):
+
+    def fake_projects(self):
+        return dict((p, make_files(p, {'Biospecimen' : 30}))
+                    for p in ('TCGA-AAA', 'TCGA-BBB'))
+
+    def test_projects_served_from_cache(self):
+        api.set_cache(ResponseCache(self.path('cache')))
+        self.assertEqual(api.get_projects(), ['TCGA-AAA', 'TCGA-BBB'])
+        served = len(self.gdc.requests)
+        self.assertEqual(api.get_projects(), ['TCGA-AAA', 'TCGA-BBB'])
+        self.assertEqual(len(self.gdc.requests), served)
+
+    def test_cases_and_files_stream_uncached(self):
+        api.set_cache(ResponseCache(self.path('cache')))
+        pages = list(api.GDCQuery('cases').iter_pages(page_size=1))
+        self.assertEqual(len(pages), 60)
+        pages = list(api.GDCQuery('files').iter_pages(page_size=7))
+        self.assertEqual(len(pages), 9)
+        self.assertEqual(cached_entries(self.path('cache')), [])
+
+    def test_cases_cached_when_configured(self):
+        api.set_cache(ResponseCache(self.path('cache'), ttls={'cases' : 60}))
+        self.assertEqual(len(api.GDCQuery('cases').get(page_size=7)), 60)
+        served = len(self.gdc.requests)
+        self.assertEqual(len(api.GDCQuery('cases').get(page_size=7)), 60)
+        self.assertEqual(len(self.gdc.requests), served)
+
+    def test_pinned_datestamp(self):
+        root = self.path('cache')
+        cache = ResponseCache(root, datestamp='2017_01_01')
+        cache.store('projects', {'q' : 1}, ['old'])
+        cache = ResponseCache(root, ttls={'projects' : 0.000001},
+                              datestamp='2017_01_01', pinned=True)
+        self.assertEqual(cache.lookup('projects', {'q' : 1}), ['old'])
+        self.assertEqual(cache.lookup('projects', {'q' : 2}), None)
+
+    def test_eviction_is_bounded(self):
+        root = self.path('cache')
+        cache = ResponseCache(root, max_bytes=64 * 1024)
+        for n in range(200):
+            cache.store('projects', {'q' : n}, ['x' * 1000])
+        total = sum(os.path.getsize(p) for p in cached_entries(root))
+        # At most max_bytes / EVICT_FRACTION more than max_bytes
+        self.assertTrue(total <= 68 * 1024, total)
+        # The most recently stored entries are kept
+        self.assertEqual(cache.lookup('projects', {'q' : 199}), ['x' * 1000])
+
+    def test_eviction_is_infrequent(self):
+        cache = CountingCache(self.path('cache'), max_bytes=1024 * 1024)
+        for n in range(200):
+            cache.store('projects', {'q' : n}, ['x' * 1000])
+        # Once at first, then after each 64 KB stored
+        self.assertTrue(1 <= cache.walks <= 5, cache.walks)
+
+    def test_failed_store_leaves_no_temporary_file(self):
+        cache = ResponseCache(self.path('cache'))
+        self.assertRaises(TypeError, cache.store, 'projects', {'q' : 1},
+                          [object()])
+        leftovers = [f for d, _, files in os.walk(self.path('cache'))
+                     for f in files]
+        self.assertEqual(leftovers, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of GDC queries with long filters: POSTed filters, and huge
+'in' filters split into chunks whose hits are merged'''
+
+import unittest
+
+from fakegdc import GDCTestCase, make_files
+import lib.api as api
+
+class TestChunkedQueries(GDCTestCase):
+
+    def fake_projects(self):
+        return { 'TCGA-FAKE' : make_files('TCGA-FAKE', {'Biospecimen' : 120}) }
+
+    def setUp(self):
+        super(TestChunkedQueries, self).setUp()
+        self.limits = (api.GDCQuery.IN_CHUNK_SIZE,
+                       api.GDCQuery.POST_FILTER_LENGTH)
+
+    def tearDown(self):
+        (api.GDCQuery.IN_CHUNK_SIZE,
+         api.GDCQuery.POST_FILTER_LENGTH) = self.limits
+        super(TestChunkedQueries, self).tearDown()
+
+    def uuids(self):
+        return sorted(fd['file_id'] for fd in self.gdc.projects['TCGA-FAKE'])
+
+    def test_chunks_merged_in_order(self):
+        api.GDCQuery.IN_CHUNK_SIZE = 7
+        # Every 3rd file, plus unknown uuids, in reverse order
+        wanted = self.uuids()[::3]
+        values = list(reversed(wanted)) + ['no-such-uuid-%d' % n
+                                           for n in range(10)]
+        query = api.GDCQuery('files')
+        query.add_in_filter('file_id', values)
+        query.add_eq_filter('access', 'open')
+        hits = query.get(page_size=5)
+        self.assertEqual([h['file_id'] for h in hits], wanted)
+
+    def test_chunk_range(self):
+        api.GDCQuery.IN_CHUNK_SIZE = 10
+        query = api.GDCQuery('files')
+        query.add_in_filter('file_id', self.uuids())
+        hits = [h for p in query.iter_pages(page_size=50, from_idx=11,
+                                            to_idx=30)
+                for h in p]
+        self.assertEqual([h['file_id'] for h in hits], self.uuids()[10:30])
+
+    def test_long_filters_posted(self):
+        api.GDCQuery.POST_FILTER_LENGTH = 100
+        query = api.GDCQuery('files')
+        query.add_in_filter('file_id', self.uuids()[:40])
+        self.assertEqual([h['file_id'] for h in query.get(page_size=15)],
+                         self.uuids()[:40])
+        methods = set(r[0] for r in self.gdc.requests)
+        self.assertEqual(methods, set(['POST']))
+
+    def test_merge_hits(self):
+        pages = [[{'file_id' : 'c'}, {'file_id' : 'a'}],
+                 [{'file_id' : 'b'}, {'file_id' : 'a'}],
+                 [{'other' : 1}]]
+        merged = api._merge_hits(pages, 'file_id')
+        self.assertEqual(merged, [{'file_id' : 'a'}, {'file_id' : 'b'},
+                                  {'file_id' : 'c'}, {'other' : 1}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of gdc_diff, comparing the metadata of two mirror
+datestamps'''
+
+import os
+import csv
+import unittest
+
+from fakegdc import GDCTestCase, make_files, set_content
+import lib.meta as meta
+
+EARLIER, LATER = '2017_01_01', '2017_02_01'
+
+def public(files):
+    return [dict((k, v) for k, v in fd.items() if k != '_content')
+            for fd in files]
+
+class TestDiff(GDCTestCase):
+
+    def setUp(self):
+        super(TestDiff, self).setUp()
+        self.cache_size = meta.SNAPSHOT_CACHE_SIZE
+        meta.SNAPSHOT_CACHE_SIZE = 0
+
+        # TCGA-AAA: one file changed, one removed and one added on LATER
+        files = make_files('TCGA-AAA')
+        self.write_metadata('TCGA-AAA', EARLIER, files)
+        set_content(files[0], b'changed\n')
+        added = dict(files[1], file_id='tcga-aaa-new')
+        self.write_metadata('TCGA-AAA', LATER, files[:-1] + [added])
+        self.changed = files[0]['file_id']
+        self.removed = files[-1]['file_id']
+        self.added = added['file_id']
+
+        # TCGA-BBB was not mirrored on LATER, so nothing was removed from it
+        self.write_metadata('TCGA-BBB', EARLIER, make_files('TCGA-BBB'))
+        with open(self.path('datestamps.txt'), 'w') as f:
+            f.write(EARLIER + '\n' + LATER + '\n')
+
+    def tearDown(self):
+        meta.SNAPSHOT_CACHE_SIZE = self.cache_size
+        super(TestDiff, self).tearDown()
+
+    def write_metadata(self, project, datestamp, files):
+        proj_dir = self.path('mirror', 'TCGA', project)
+        meta.write_project_metadata(proj_dir, datestamp, public(files))
+
+    def diff(self, *args):
+        import gdc_diff
+        output = self.path('diff.tsv')
+        self.run_tool(gdc_diff.gdc_diff, '--config', self.write_config(),
+                      '-o', output, *args)
+        with open(output) as f:
+            return list(csv.DictReader(f, delimiter='\t'))
+
+    def check_report(self):
+        rows = self.diff()
+        self.assertEqual(sorted((r['status'], r['project'], r['uuid'])
+                                for r in rows),
+                         [('added', 'TCGA-AAA', self.added),
+                          ('changed', 'TCGA-AAA', self.changed),
+                          ('removed', 'TCGA-AAA', self.removed)])
+
+    def test_diff(self):
+        self.check_report()
+        # The indexes made are kept, and used by the next comparison
+        stamp_dir = self.path('mirror', 'TCGA', 'TCGA-AAA', 'metadata', LATER)
+        self.assertTrue(os.path.isfile(os.path.join(stamp_dir,
+                        'index.TCGA-AAA.%s.tsv' % LATER)))
+        self.check_report()
+
+    def test_summary(self):
+        rows = self.diff('--summary')
+        self.assertEqual([(r['project'], r['data_category'], r['added'],
+                           r['removed'], r['changed']) for r in rows],
+                         [('TCGA-AAA', 'Biospecimen', '1', '0', '1'),
+                          ('TCGA-AAA', 'Copy Number Variation', '0', '1', '0')])
+
+    def test_unwritable_mirror(self):
+        # Indexes that cannot be kept in the mirror (as when it is read-only,
+        # which the superuser running tests would not notice) are made in
+        # memory; a folder in the way of each makes writing it fail
+        blocked = []
+        for project in ('TCGA-AAA', 'TCGA-BBB'):
+            for stamp in (EARLIER, LATER):
+                stamp_dir = self.path('mirror', 'TCGA', project, 'metadata',
+                                      stamp)
+                if os.path.isdir(stamp_dir):
+                    os.mkdir(os.path.join(stamp_dir, 'index.%s.%s.tsv' % \
+                                          (project, stamp)))
+                    blocked.append(stamp_dir)
+        listings = [sorted(os.listdir(d)) for d in blocked]
+        self.check_report()
+        self.assertEqual([sorted(os.listdir(d)) for d in blocked], listings)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of file downloads: resuming from .part files, verifying
+them, and reusing connections'''
+
+import os
+import unittest
+
+from fakegdc import GDCTestCase
+import lib.api as api
+
+UUID = 'tcga-fake-cop-0003'
+
+class TestDownload(GDCTestCase):
+
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        self.file_dict = self.gdc.files()[UUID]
+        self.content = self.file_dict['_content']
+        self.savepath = self.path('cop.3.txt')
+
+    def write_part(self, data):
+        with open(self.savepath + api.PARTIAL_SUFFIX, 'wb') as f:
+            f.write(data)
+
+    def download(self, **kwargs):
+        return api.py_download_file(UUID, self.savepath,
+                                    file_size=len(self.content),
+                                    md5sum=self.file_dict['md5sum'], **kwargs)
+
+    def downloaded(self):
+        with open(self.savepath, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        self.assertEqual(self.download(chunk_size=100),
+                         (self.file_dict['md5sum'], len(self.content)))
+        self.assertEqual(self.downloaded(), self.content)
+        self.assertFalse(os.path.exists(self.savepath + api.PARTIAL_SUFFIX))
+        self.assertEqual(self.gdc.offsets, [])
+
+    def test_resume(self):
+        self.write_part(self.content[:1000])
+        self.assertEqual(self.download(chunk_size=100)[0],
+                         self.file_dict['md5sum'])
+        self.assertEqual(self.gdc.offsets, [1000])
+        self.assertEqual(self.downloaded(), self.content)
+
+    def test_resume_corrupt_partial_file(self):
+        # The earlier bytes are hashed too, so a bad .part file is caught
+        self.write_part(b'x' * 1000)
+        self.assertRaises(api.ChecksumError, self.download)
+        self.assertFalse(os.path.exists(self.savepath))
+        self.assertFalse(os.path.exists(self.savepath + api.PARTIAL_SUFFIX))
+        # ... and the next attempt starts over
+        self.download()
+        self.assertEqual(self.downloaded(), self.content)
+
+    def test_resume_refused(self):
+        # A server ignoring the Range header sends the whole file again
+        self.gdc.ranges = False
+        self.write_part(self.content[:1000])
+        self.download()
+        self.assertEqual(self.downloaded(), self.content)
+
+    def test_oversized_partial_file(self):
+        self.write_part(self.content + b'extra')
+        self.download()
+        self.assertEqual(self.gdc.offsets, [])
+        self.assertEqual(self.downloaded(), self.content)
+
+    def test_interrupted_download_kept(self):
+        def interrupted():
+            yield self.content[:700]
+            yield self.content[700:1500]
+            raise IOError("Connection lost")
+        part_name = self.savepath + api.PARTIAL_SUFFIX
+        self.assertRaises(IOError, api._write_download, part_name,
+                          interrupted(), 0, len(self.content))
+        # Truncated to the data received, whatever was preallocated
+        self.assertEqual(api._partial_size(part_name, len(self.content)), 1500)
+        self.download()
+        self.assertEqual(self.gdc.offsets, [1500])
+        self.assertEqual(self.downloaded(), self.content)
+
+    def test_connection_reused(self):
+        for file_dict in self.gdc.files().values():
+            savepath = self.path(file_dict['file_id'])
+            api.py_download_file(file_dict['file_id'], savepath,
+                                 file_size=file_dict['file_size'],
+                                 md5sum=file_dict['md5sum'])
+        ports = set(port for _, _, port in self.gdc.data_requests())
+        self.assertEqual(len(self.gdc.data_requests()), 12)
+        self.assertEqual(len(ports), 1)
+
+if __name__ == '__main__':
+    unittest.main()
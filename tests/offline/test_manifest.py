@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of the manifest of mirrored files'''
+
+import os
+import unittest
+
+from fakegdc import GDCTestCase, set_content
+from lib.manifest import Manifest
+
+class TestManifest(GDCTestCase):
+
+    def manifest(self):
+        manifest = Manifest(self.path('mirror', 'TCGA'))
+        self.addCleanup(manifest.close)
+        return manifest
+
+    def test_relative_paths(self):
+        prog_root = self.path('mirror', 'TCGA')
+        os.makedirs(os.path.join(prog_root, 'TCGA-FAKE'))
+        with open(os.path.join(prog_root, 'TCGA-FAKE', 'a.txt'), 'w') as f:
+            f.write('a\n')
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            manifest = Manifest(os.path.join('mirror', 'TCGA'))
+            manifest.record('TCGA-FAKE', 'uuid-a',
+                            os.path.join('mirror', 'TCGA', 'TCGA-FAKE', 'a.txt'),
+                            2, 'md5-a', '2017_01_01')
+        finally:
+            os.chdir(cwd)
+        entry = manifest.lookup('uuid-a')
+        manifest.close()
+        self.assertEqual(entry.path, os.path.join('TCGA-FAKE', 'a.txt'))
+        self.assertEqual(os.path.realpath(manifest.full_path(entry)),
+                         os.path.realpath(os.path.join(prog_root, 'TCGA-FAKE',
+                                                       'a.txt')))
+
+    def test_first_seen_preserved(self):
+        os.makedirs(self.path('mirror', 'TCGA'))
+        manifest = self.manifest()
+        path = self.path('mirror', 'TCGA', 'a.txt')
+        manifest.record('TCGA-FAKE', 'uuid-a', path, 2, 'md5-a', '2017_01_01',
+                        mtime=1)
+        manifest.record('TCGA-FAKE', 'uuid-a', path, 3, 'md5-b', '2017_02_01',
+                        mtime=2)
+        entry = manifest.lookup('uuid-a')
+        self.assertEqual((entry.size, entry.md5, entry.first_seen),
+                         (3, 'md5-b', '2017_01_01'))
+        self.assertTrue(manifest.is_mirrored({'file_id' : 'uuid-a',
+                                              'md5sum' : 'md5-b'}))
+        self.assertFalse(manifest.is_mirrored({'file_id' : 'uuid-a',
+                                               'md5sum' : 'md5-a'}))
+        manifest.remove(['uuid-a'])
+        self.assertEqual(manifest.lookup('uuid-a'), None)
+
+    def test_mirror_records_files(self):
+        self.run_mirror()
+        entries = self.manifest().entries('TCGA-FAKE')
+        self.assertEqual(sorted(entries), sorted(self.gdc.files()))
+        mirrored = self.mirrored_files()
+        for uuid, entry in entries.items():
+            file_dict = self.gdc.files()[uuid]
+            self.assertEqual((entry.md5, entry.size),
+                             (file_dict['md5sum'], file_dict['file_size']))
+            self.assertTrue(os.path.basename(entry.path) in mirrored)
+
+    def test_changed_file_remirrored(self):
+        self.run_mirror()
+        file_dict = self.gdc.files()['tcga-fake-cli-0001']
+        set_content(file_dict, b'new content\n')
+        self.run_mirror(incremental='yes')
+        entry = self.manifest().lookup('tcga-fake-cli-0001')
+        self.assertEqual(entry.md5, file_dict['md5sum'])
+        with open(self.manifest().full_path(entry), 'rb') as f:
+            self.assertEqual(f.read(), b'new content\n')
+
+    def test_rebuild(self):
+        self.run_mirror()
+        before = self.manifest().entries()
+        os.remove(self.path('mirror', 'TCGA', Manifest.FILE_NAME))
+        self.run_mirror('--rebuild-manifest')
+        after = self.manifest().entries()
+        self.assertEqual(sorted(after), sorted(before))
+        for uuid in before:
+            self.assertEqual(after[uuid]._replace(mtime=None),
+                             before[uuid]._replace(mtime=None))
+
+if __name__ == '__main__':
+    unittest.main()
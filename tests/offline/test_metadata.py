@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of datestamped metadata stored in full or as deltas'''
+
+import os
+import json
+import unittest
+
+from fakegdc import GDCTestCase, make_files, set_content
+import lib.meta as meta
+
+DATESTAMPS = ['2017_01_0%d' % n for n in range(1, 8)]
+
+class TestMetadataDeltas(GDCTestCase):
+
+    def setUp(self):
+        super(TestMetadataDeltas, self).setUp()
+        # Read every snapshot from disk, not from the cache of recent ones
+        self.cache_size = meta.SNAPSHOT_CACHE_SIZE
+        meta.SNAPSHOT_CACHE_SIZE = 0
+        self.proj_dir = self.path('mirror', 'TCGA', 'TCGA-FAKE')
+
+    def tearDown(self):
+        meta.SNAPSHOT_CACHE_SIZE = self.cache_size
+        super(TestMetadataDeltas, self).tearDown()
+
+    def files(self):
+        return [dict((k, v) for k, v in fd.items() if k != '_content')
+                for fd in make_files('TCGA-FAKE')]
+
+    def evolve(self, files, n):
+        '''Return the metadata of the n-th release: one file changed, one
+        removed and one added'''
+        files = [dict(fd) for fd in files]
+        set_content(files[n], ('release %d\n' % n).encode())
+        del files[n]['_content']
+        del files[-1]
+        added = dict(files[0], file_id='new-%d' % n)
+        return meta.merge_metadata(files, [added])
+
+    def write(self, releases, max_deltas):
+        paths = []
+        parent = None
+        for datestamp, files in zip(DATESTAMPS, releases):
+            paths.append(meta.write_project_metadata(self.proj_dir, datestamp,
+                                                     files, parent,
+                                                     max_deltas))
+            parent = datestamp
+        return paths
+
+    def releases(self, count):
+        releases = [meta.merge_metadata(self.files(), [])]
+        for n in range(1, count):
+            releases.append(self.evolve(releases[-1], n))
+        return releases
+
+    def test_delta_chain(self):
+        releases = self.releases(7)
+        paths = self.write(releases, max_deltas=3)
+        kinds = [os.path.basename(p).split('.')[0] for p in paths]
+        self.assertEqual(kinds, ['metadata', 'delta', 'delta', 'delta',
+                                 'metadata', 'delta', 'delta'])
+        self.assertEqual([meta.metadata_depth(self.proj_dir, d)
+                          for d in DATESTAMPS], [0, 1, 2, 3, 0, 1, 2])
+        for datestamp, files in zip(DATESTAMPS, releases):
+            self.assertEqual(meta.read_project_metadata(self.proj_dir,
+                                                        datestamp), files)
+            stamp_dir = os.path.join(self.proj_dir, 'metadata', datestamp)
+            self.assertEqual(meta.latest_metadata(stamp_dir), files)
+            self.assertTrue(meta.has_metadata(self.proj_dir, datestamp))
+
+    def test_delta_is_small_and_compact(self):
+        releases = self.releases(2)
+        paths = self.write(releases, max_deltas=1)
+        with open(paths[1]) as df:
+            text = df.read()
+        self.assertFalse('\n' in text or ', ' in text)
+        delta = json.loads(text)
+        self.assertEqual(delta['parent'], DATESTAMPS[0])
+        self.assertEqual(sorted(fd['file_id'] for fd in delta['changed']),
+                         sorted([releases[0][1]['file_id'], 'new-1']))
+        self.assertEqual(delta['removed'], [releases[0][-1]['file_id']])
+
+    def test_no_deltas(self):
+        paths = self.write(self.releases(3), max_deltas=0)
+        self.assertTrue(all(os.path.basename(p).startswith('metadata.')
+                            for p in paths))
+
+    def test_rewritten_datestamp(self):
+        # A second mirror on the same day replaces the metadata of the first
+        releases = self.releases(3)
+        self.write(releases[:2], max_deltas=5)
+        meta.write_project_metadata(self.proj_dir, DATESTAMPS[1], releases[2],
+                                    None, 5)
+        self.assertEqual(meta.metadata_depth(self.proj_dir, DATESTAMPS[1]), 0)
+        self.assertEqual(meta.read_project_metadata(self.proj_dir,
+                                                    DATESTAMPS[1]),
+                         releases[2])
+        meta.write_project_metadata(self.proj_dir, DATESTAMPS[1], releases[1],
+                                    DATESTAMPS[0], 5)
+        stamp_dir = os.path.join(self.proj_dir, 'metadata', DATESTAMPS[1])
+        self.assertEqual([f for f in os.listdir(stamp_dir)
+                          if f.startswith('metadata.')], [])
+        self.assertEqual(meta.read_project_metadata(self.proj_dir,
+                                                    DATESTAMPS[1]),
+                         releases[1])
+
+    def test_invalid_parent(self):
+        self.write(self.releases(2), max_deltas=1)
+        delta_json = os.path.join(self.proj_dir, 'metadata', DATESTAMPS[1],
+                                  'delta.TCGA-FAKE.%s.json' % DATESTAMPS[1])
+        with open(delta_json) as df:
+            delta = json.load(df)
+        delta['parent'] = DATESTAMPS[1]
+        with open(delta_json, 'w') as df:
+            json.dump(delta, df)
+        self.assertRaises(ValueError, meta.read_project_metadata,
+                          self.proj_dir, DATESTAMPS[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of gdc_mirror against a fake GDC'''
+
+import os
+import logging
+import unittest
+
+from fakegdc import GDCTestCase, make_files, set_content
+
+class LogRecorder(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class TestMirror(GDCTestCase):
+
+    def setUp(self):
+        super(TestMirror, self).setUp()
+        self.log = LogRecorder()
+        logging.getLogger().addHandler(self.log)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.log)
+        super(TestMirror, self).tearDown()
+
+    def new_files(self, category):
+        '''Return the numbers of new files of category logged so far'''
+        suffix = ' new %s files' % category
+        return [int(m.split()[0]) for m in self.log.messages
+                if m.endswith(suffix)]
+
+    def test_full_mirror(self):
+        self.run_mirror()
+        mirrored = self.mirrored_files()
+        self.assertEqual(len(mirrored), 12)
+        for file_dict in self.gdc.files().values():
+            path = mirrored[file_dict['file_name'].replace('.txt', '.') +
+                            file_dict['file_id'] + '.txt']
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), file_dict['_content'])
+        self.assertEqual(self.new_files('Biospecimen'), [5])
+
+    def test_failed_download_not_mirrored(self):
+        self.gdc.broken.add('tcga-fake-bio-0002')
+        self.run_mirror()
+        self.assertEqual(self.new_files('Biospecimen'), [4])
+        self.assertEqual(len(self.mirrored_files()), 11)
+
+        # Retried by the next (incremental) mirror, once GDC serves it intact
+        self.gdc.broken.clear()
+        self.run_mirror(incremental='yes')
+        self.assertEqual(self.new_files('Biospecimen'), [4, 1])
+        self.assertEqual(self.new_files('Clinical'), [3, 0])
+        self.assertEqual(len(self.mirrored_files()), 12)
+
+class TestProjectJobs(GDCTestCase):
+
+    PROJECTS = ['TCGA-AAA', 'TCGA-BBB', 'TCGA-CCC']
+
+    def fake_projects(self):
+        return dict((p, make_files(p)) for p in self.PROJECTS)
+
+    def test_concurrent_projects(self):
+        self.run_mirror(project_jobs=2, jobs=3)
+        for project in self.PROJECTS:
+            self.assertEqual(len(self.mirrored_files(project)), 12)
+
+        # Incremental syncs of the projects also run concurrently
+        for project in self.PROJECTS:
+            file_dict = self.gdc.projects[project][0]
+            set_content(file_dict, ('new %s\n' % project).encode())
+        self.run_mirror(project_jobs=2, jobs=3, incremental='yes')
+        for project in self.PROJECTS:
+            file_dict = self.gdc.projects[project][0]
+            mirrored = self.mirrored_files(project)
+            name = 'bio.0.%s.txt' % file_dict['file_id']
+            with open(mirrored[name], 'rb') as f:
+                self.assertEqual(f.read(), file_dict['_content'])
+
+if __name__ == '__main__':
+    unittest.main()
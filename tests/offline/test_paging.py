@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of GDCQuery paging: concurrently fetched pages must be
+yielded in server order, without gaps or duplicates'''
+
+import time
+import random
+import unittest
+
+from fakegdc import GDCTestCase, make_files
+import lib.api as api
+
+class TestPaging(GDCTestCase):
+
+    def fake_projects(self):
+        return { 'TCGA-FAKE' : make_files('TCGA-FAKE', {'Biospecimen' : 237}) }
+
+    def expected(self):
+        return sorted(fd['file_id'] for fd in self.gdc.projects['TCGA-FAKE'])
+
+    def test_concurrent_pages_in_order(self):
+        query = api.GDCQuery('files')
+        pages = list(query.iter_pages(page_size=20, workers=4))
+        self.assertEqual(len(pages), 12)
+        self.assertEqual([h['file_id'] for p in pages for h in p],
+                         self.expected())
+
+    def test_page_range(self):
+        query = api.GDCQuery('files')
+        hits = query.get(page_size=20, workers=3, to_idx=45)
+        self.assertEqual([h['file_id'] for h in hits], self.expected()[:45])
+        hits = [h for p in api.GDCQuery('files').iter_pages(20, 31, 60, 3)
+                for h in p]
+        self.assertEqual([h['file_id'] for h in hits], self.expected()[30:60])
+
+    def test_automatic_page_size(self):
+        query = api.GDCQuery('files')
+        hits = list(query.iter_hits(page_size=0, workers=2))
+        self.assertEqual([h['file_id'] for h in hits], self.expected())
+
+    def test_ordered_imap(self):
+        def slow_square(n):
+            time.sleep(random.uniform(0, 0.01))
+            return n * n
+        self.assertEqual(list(api._ordered_imap(slow_square, range(50), 8)),
+                         [n * n for n in range(50)])
+
+if __name__ == '__main__':
+    unittest.main()
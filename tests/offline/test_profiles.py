@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of the measurement of metadata field profiles'''
+
+import unittest
+
+from fakegdc import GDCTestCase, make_files
+import lib.api as api
+
+class TestFileProfiles(GDCTestCase):
+
+    def fake_projects(self):
+        return { 'TCGA-FAKE' : make_files('TCGA-FAKE', {'Biospecimen' : 80}) }
+
+    def measure(self):
+        sizes = api.measure_file_profiles('TCGA-FAKE', 'Biospecimen')
+        self.assertEqual(sorted(sizes), sorted(api.FILE_FIELD_PROFILES))
+        return sizes
+
+    def test_uncompressed(self):
+        for decoded, transferred in self.measure().values():
+            self.assertEqual(decoded, transferred)
+
+    def test_compressed_and_chunked(self):
+        self.gdc.compress = True
+        for decoded, transferred in self.measure().values():
+            # The same JSON compresses well, but is sent in several chunks
+            self.assertTrue(0 < transferred < decoded / 4.0,
+                            (decoded, transferred))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''Offline tests of the content-addressed store of mirrored files'''
+
+import os
+import hashlib
+import unittest
+
+from fakegdc import GDCTestCase, make_files
+from lib.store import ObjectStore
+
+class TestObjectStore(GDCTestCase):
+
+    def write(self, name, content):
+        path = self.path(name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_add_and_link(self):
+        store = ObjectStore(self.path('store'))
+        md5 = hashlib.md5(b'data\n').hexdigest()
+        first = self.write('first', b'data\n')
+        self.assertEqual(store.size(md5), None)
+        self.assertTrue(store.add(first, md5))
+        self.assertEqual(store.size(md5), 5)
+        self.assertFalse(store.add(first, md5))
+        self.assertTrue(os.path.samefile(first, store.path(md5)))
+
+        store.link(md5, self.path('linked'))
+        self.assertTrue(os.path.samefile(self.path('linked'), first))
+        self.assertTrue(store.same_file_system(self.tmpdir))
+
+    def test_add_replaces_other_copy(self):
+        store = ObjectStore(self.path('store'))
+        md5 = hashlib.md5(b'data\n').hexdigest()
+        store.add(self.write('first', b'data\n'), md5)
+        second = self.write('second', b'data\n')
+        self.assertTrue(store.add(second, md5))
+        self.assertTrue(os.path.samefile(second, store.path(md5)))
+        self.assertEqual(os.listdir(os.path.dirname(store.path(md5))), [md5])
+
+    def test_gc(self):
+        store = ObjectStore(self.path('store'))
+        kept = self.write('kept', b'kept\n')
+        store.add(kept, hashlib.md5(b'kept\n').hexdigest())
+        dropped = self.write('dropped', b'dropped!\n')
+        dropped_md5 = hashlib.md5(b'dropped!\n').hexdigest()
+        store.add(dropped, dropped_md5)
+        os.remove(dropped)
+        self.assertEqual(store.gc(dry_run=True), (1, 9))
+        self.assertEqual(store.size(dropped_md5), 9)
+        self.assertEqual(store.gc(), (1, 9))
+        self.assertEqual(store.size(dropped_md5), None)
+        self.assertEqual(store.gc(), (0, 0))
+
+class TestMirrorStore(GDCTestCase):
+
+    PROJECTS = ['TCGA-AAA', 'TCGA-BBB']
+
+    def fake_projects(self):
+        # The n-th file of a category has the same content in each project
+        return dict((p, make_files(p)) for p in self.PROJECTS)
+
+    def mirror(self, *args):
+        return self.run_mirror('--store', self.path('store'), *args)
+
+    def check_mirror(self):
+        store = ObjectStore(self.path('store'))
+        for project in self.PROJECTS:
+            mirrored = self.mirrored_files(project)
+            self.assertEqual(len(mirrored), 12)
+            for file_dict in self.gdc.projects[project]:
+                name = file_dict['file_name'].replace('.txt', '.') + \
+                       file_dict['file_id'] + '.txt'
+                with open(mirrored[name], 'rb') as f:
+                    self.assertEqual(f.read(), file_dict['_content'])
+                self.assertTrue(os.path.samefile(mirrored[name],
+                                        store.path(file_dict['md5sum'])))
+
+    def test_shared_files_stored_once(self):
+        self.mirror()
+        self.check_mirror()
+        # The files of the second project were linked, not downloaded
+        self.assertEqual(len(self.gdc.data_requests()), 12)
+
+    def test_damaged_file_repaired(self):
+        self.mirror()
+        path = self.mirrored_files('TCGA-AAA')['bio.0.tcga-aaa-bio-0000.txt']
+        with open(path, 'r+b') as f:
+            f.write(b'X')
+        # Without --force-download stored files are trusted...
+        self.mirror()
+        self.assertEqual(len(self.gdc.data_requests()), 12)
+
+        # ... but a forced download replaces the damaged object, and the
+        # files linked to it
+        self.mirror('--force-download')
+        for project in self.PROJECTS:
+            with open(self.mirrored_files(project)[
+                      'bio.0.%s-bio-0000.txt' % project.lower()], 'rb') as f:
+                self.assertEqual(f.read(),
+                                 self.gdc.projects[project][0]['_content'])
+        store = ObjectStore(self.path('store'))
+        md5 = self.gdc.projects['TCGA-AAA'][0]['md5sum']
+        with open(store.path(md5), 'rb') as f:
+            self.assertEqual(hashlib.md5(f.read()).hexdigest(), md5)
+
+if __name__ == '__main__':
+    unittest.main()